@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 import csv
+import json
+import random
 import subprocess
 import os
 import sys
@@ -13,13 +15,16 @@ SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 OUTPUT_DIR = os.path.join(SCRIPT_DIR, 'output')
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+# powershell脚本目录（与OUTPUT_DIR一样在导入时计算一次）
+PS_DIR = os.path.join(SCRIPT_DIR, 'powershell')
+
 def get_output_path(filename):
     """获取output目录下文件的绝对路径"""
-    return os.path.join(SCRIPT_DIR, 'output', filename)
+    return os.path.join(OUTPUT_DIR, filename)
 
 def get_ps_path(filename):
     """获取powershell目录下文件的绝对路径"""
-    return os.path.join(SCRIPT_DIR, 'powershell', filename)
+    return os.path.join(PS_DIR, filename)
 
 # 加载环境变量
 load_dotenv(os.path.join(SCRIPT_DIR, '.env'))
@@ -38,93 +43,231 @@ SSH_CONTROL_PATH = "/tmp/ssh-feishu-ad-sync-%r@%h:%p"
 SSH_CONTROL_MASTER_INITIALIZED = False
 DC_USER_HOME = None
 
+def ssh_argv(remote_cmd, *extra_opts):
+    """构建复用ControlMaster的ssh命令参数列表（主连接已认证，无需密码）"""
+    return ["ssh", "-o", "StrictHostKeyChecking=no", "-o", "BatchMode=yes",
+            "-o", f"ControlPath={SSH_CONTROL_PATH}", *extra_opts,
+            f"{DC_USER}@{DC_HOST}", remote_cmd]
+
+def scp_argv(sources, remote_path):
+    """构建复用ControlMaster的scp命令参数列表，支持一次上传多个文件"""
+    if isinstance(sources, str):
+        sources = [sources]
+    return ["scp", "-o", "BatchMode=yes", "-o", f"ControlPath={SSH_CONTROL_PATH}",
+            *sources, f"{DC_USER}@{DC_HOST}:{remote_path}"]
+
+def scp_download_argv(remote_path, local_path):
+    """构建从域控制器下载文件的scp命令参数列表"""
+    return ["scp", "-o", "BatchMode=yes", "-o", f"ControlPath={SSH_CONTROL_PATH}",
+            f"{DC_USER}@{DC_HOST}:{remote_path}", local_path]
+
+def check_ssh_control_master():
+    """检查ControlMaster主连接是否存活"""
+    result = subprocess.run(
+        ["ssh", "-o", f"ControlPath={SSH_CONTROL_PATH}", "-O", "check", f"{DC_USER}@{DC_HOST}"],
+        capture_output=True)
+    return result.returncode == 0
+
 def init_ssh_control_master():
     """初始化SSH ControlMaster连接"""
     global SSH_CONTROL_MASTER_INITIALIZED
-    
+
     if SSH_CONTROL_MASTER_INITIALIZED:
         return
-    
-    cmd = f"sshpass -p '{DC_PASSWORD}' ssh -o StrictHostKeyChecking=no -o ControlMaster=yes -o ControlPath={SSH_CONTROL_PATH} -o ControlPersist=5m -fN {DC_USER}@{DC_HOST}"
-    try:
-        subprocess.run(cmd, shell=True, capture_output=True, timeout=10)
+
+    # 先检查是否已有存活的主连接（如上次运行在ControlPersist窗口内），有则直接复用
+    if check_ssh_control_master():
         SSH_CONTROL_MASTER_INITIALIZED = True
+        return
+
+    # 密码通过 SSHPASS 环境变量传递（sshpass -e），避免出现在进程参数列表中
+    cmd = ["sshpass", "-e", "ssh",
+           "-o", "StrictHostKeyChecking=no", "-o", "ControlMaster=yes",
+           "-o", f"ControlPath={SSH_CONTROL_PATH}", "-o", "ControlPersist=5m",
+           "-fN", f"{DC_USER}@{DC_HOST}"]
+    try:
+        subprocess.run(cmd, capture_output=True, timeout=10,
+                       env={**os.environ, "SSHPASS": DC_PASSWORD})
+        # 验证主连接存活，后续的ssh/scp全部复用此连接
+        SSH_CONTROL_MASTER_INITIALIZED = check_ssh_control_master()
     except:
         pass
 
+DC_USER_HOME_CACHE = os.path.join(OUTPUT_DIR, '.dc_user_home_cache')
+
+def _load_cached_dc_user_home(cache_key):
+    """从本地缓存读取域控制器用户主目录"""
+    try:
+        with open(DC_USER_HOME_CACHE, 'r', encoding='utf-8') as f:
+            return json.load(f).get(cache_key)
+    except (OSError, ValueError):
+        return None
+
+def _save_cached_dc_user_home(cache_key, home):
+    """把域控制器用户主目录写入本地缓存"""
+    try:
+        cache = {}
+        if os.path.exists(DC_USER_HOME_CACHE):
+            with open(DC_USER_HOME_CACHE, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+        cache[cache_key] = home
+        with open(DC_USER_HOME_CACHE, 'w', encoding='utf-8') as f:
+            json.dump(cache, f)
+    except (OSError, ValueError):
+        pass
+
 def init_dc_user_home():
-    """初始化域控制器用户主目录路径"""
+    """初始化域控制器用户主目录路径
+
+    主目录对同一(用户,主机)是稳定值，缓存到本地文件后可省掉
+    每次运行的SSH往返；缓存失效时删除 output/.dc_user_home_cache 即可。
+    """
     global DC_USER_HOME
-    
+
     if DC_USER_HOME:
         return DC_USER_HOME
-    
+
+    cache_key = f"{DC_USER}@{DC_HOST}"
+    cached = _load_cached_dc_user_home(cache_key)
+    if cached:
+        DC_USER_HOME = cached
+        return DC_USER_HOME
+
     init_ssh_control_master()
-    
+
     try:
-        cmd = f"sshpass -p '{DC_PASSWORD}' ssh -o StrictHostKeyChecking=no -o ControlPath={SSH_CONTROL_PATH} {DC_USER}@{DC_HOST} 'powershell -Command \"echo $env:USERPROFILE\"'"
+        cmd = ssh_argv('powershell -Command "echo $env:USERPROFILE"')
         result = run_ssh_with_retry(cmd, timeout=10)
         if result.returncode == 0:
             DC_USER_HOME = result.stdout.decode('utf-8').strip().replace('\\', '/')
+            _save_cached_dc_user_home(cache_key, DC_USER_HOME)
             return DC_USER_HOME
     except:
         pass
-    
+
     print(f"✗ 无法获取域控制器用户主目录")
     sys.exit(1)
 
+# 不可重试的SSH错误（认证/主机密钥问题，重试只会浪费时间）
+SSH_FATAL_ERRORS = (b'Permission denied', b'Host key verification failed')
+
+def _retry_delay(attempt):
+    """指数退避 + 随机抖动，避免多个客户端同步重试"""
+    return min(30, 0.5 * (2 ** attempt)) + random.random() * 0.5
+
+def _is_fatal_ssh_error(result):
+    """判断是否为不可恢复的SSH错误"""
+    stderr = result.stderr or b''
+    return any(err in stderr for err in SSH_FATAL_ERRORS)
+
 def run_ssh_with_retry(cmd, max_retries=3, timeout=30):
-    """执行SSH命令，带重试机制"""
+    """执行SSH命令，带重试机制（指数退避，认证失败立即返回）"""
     for attempt in range(max_retries):
         try:
-            result = subprocess.run(cmd, shell=True, capture_output=True, timeout=timeout)
-            if result.returncode == 0:
+            result = subprocess.run(cmd, capture_output=True, timeout=timeout)
+            if result.returncode == 0 or _is_fatal_ssh_error(result):
                 return result
             if attempt < max_retries - 1:
-                time.sleep(2)
+                time.sleep(_retry_delay(attempt))
         except subprocess.TimeoutExpired:
             if attempt < max_retries - 1:
-                time.sleep(2)
+                time.sleep(_retry_delay(attempt))
             else:
                 raise
         except Exception as e:
             if attempt < max_retries - 1:
-                time.sleep(2)
+                time.sleep(_retry_delay(attempt))
             else:
                 raise
     return result
 
 def run_scp_with_retry(cmd, max_retries=3):
-    """执行SCP命令，带重试机制"""
+    """执行SCP命令，带重试机制（指数退避，认证失败立即返回）
+
+    文件内容由scp直接落盘，stdout丢弃、仅保留stderr用于错误判断，
+    传输大CSV时Python进程不缓冲任何文件字节。
+    """
     for attempt in range(max_retries):
         try:
-            result = subprocess.run(cmd, shell=True, capture_output=True)
-            if result.returncode == 0:
+            result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            if result.returncode == 0 or _is_fatal_ssh_error(result):
                 return result
             if attempt < max_retries - 1:
-                time.sleep(2)
+                time.sleep(_retry_delay(attempt))
         except Exception as e:
             if attempt < max_retries - 1:
-                time.sleep(2)
+                time.sleep(_retry_delay(attempt))
             else:
                 raise
     return result
 
-def upload_dc_config():
-    """上传配置到域控制器"""
+def write_dc_config():
+    """生成域控制器配置文件，返回本地路径"""
     config_content = f"""# AD Domain Configuration
 $DC_BASE_OU = "{DC_BASE_OU}"
 $DC_DOMAIN = "{DC_DOMAIN}"
 $DC_EXCLUDE_OU = "{DC_EXCLUDE_OU}"
 $DC_RESIGNED_OU = "{DC_RESIGNED_OU}"
 """
-    
+
+    # 一次性编码为字节（BOM + CRLF换行），二进制写入，不走文本编解码层
+    payload = b"\xef\xbb\xbf" + config_content.replace("\n", "\r\n").encode("utf-8")
+
     config_file = get_output_path('dc_config.ps1')
-    with open(config_file, 'w', encoding='utf-8-sig', newline='\r\n') as f:
-        f.write(config_content)
-    
-    scp_cmd = f"sshpass -p '{DC_PASSWORD}' scp -o ControlPath={SSH_CONTROL_PATH} {config_file} {DC_USER}@{DC_HOST}:~/dc_config.ps1"
-    run_scp_with_retry(scp_cmd)
+    with open(config_file, 'wb') as f:
+        f.write(payload)
+    return config_file
+
+def iter_ad_users(csv_file=None):
+    """逐行迭代导出的AD用户CSV，内存占用与文件大小无关
+
+    下游消费者应优先使用本函数，避免把整个用户列表读入内存。
+    """
+    if csv_file is None:
+        csv_file = get_output_path('ad_users.csv')
+    with open(csv_file, 'r', encoding='utf-8-sig', newline='') as f:
+        yield from csv.DictReader(f)
+
+def count_csv_rows(csv_file):
+    """统计CSV数据行数（不含表头）
+
+    先采样文件开头判断有没有引号：无引号的导出不含字段内嵌换行，
+    按1MB块扫描换行符即可；有引号（Export-Csv 给所有字段加引号，
+    表头行就能看出来）则直接用csv.reader完整解析，不做整文件预扫。
+    """
+    with open(csv_file, 'rb') as f:
+        sample = f.read(1 << 16)
+        if b'"' not in sample:
+            count = sample.count(b'\n')
+            while chunk := f.read(1 << 20):
+                count += chunk.count(b'\n')
+            return count - 1  # 减去表头
+
+    # 字段带引号，可能嵌入换行，完整解析
+    with open(csv_file, 'r', encoding='utf-8-sig') as f:
+        return sum(1 for _ in csv.reader(f)) - 1
+
+def convert_csv_to_parquet(csv_file):
+    """把AD用户CSV转换为Parquet列式格式（可选，需要安装 pyarrow）
+
+    下游脚本如果反复读取AD数据，读Parquet比逐次解析CSV快一个数量级。
+    """
+    try:
+        import pyarrow.csv as pv
+        import pyarrow.parquet as pq
+    except ImportError:
+        print("⚠ 未安装 pyarrow，跳过 Parquet 转换（pip install pyarrow）")
+        return None
+
+    parquet_file = os.path.splitext(csv_file)[0] + '.parquet'
+    try:
+        table = pv.read_csv(csv_file)
+        pq.write_table(table, parquet_file, compression='zstd')
+        print(f"✓ 已生成 Parquet 文件: {parquet_file}")
+        return parquet_file
+    except Exception as e:
+        print(f"⚠ Parquet 转换失败: {e}")
+        return None
 
 def export_ad_users():
     """导出 AD 用户"""
@@ -138,42 +281,40 @@ def export_ad_users():
     # 初始化
     init_ssh_control_master()
     init_dc_user_home()
-    
-    # 上传配置
-    print("\n正在上传配置...")
-    upload_dc_config()
-    
-    # 上传脚本
+
+    # 检查脚本
     ps_export = get_ps_path('export_users.ps1')
     if not os.path.exists(ps_export):
         print(f"✗ 找不到脚本: {ps_export}")
         sys.exit(1)
-    
-    print("正在上传脚本...")
-    scp_cmd = f"sshpass -p '{DC_PASSWORD}' scp -o ControlPath={SSH_CONTROL_PATH} {ps_export} {DC_USER}@{DC_HOST}:~/ExportUsers.ps1"
-    run_scp_with_retry(scp_cmd)
-    
+
+    # 配置和脚本合并为一次scp上传，减少一个网络往返
+    print("\n正在上传配置和脚本...")
+    config_file = write_dc_config()
+    run_scp_with_retry(scp_argv([config_file, ps_export], '~/'))
+
     # 执行导出
     print("正在执行导出...")
-    ssh_cmd = f"sshpass -p '{DC_PASSWORD}' ssh -o StrictHostKeyChecking=no -o ControlPath={SSH_CONTROL_PATH} {DC_USER}@{DC_HOST} 'powershell -ExecutionPolicy Bypass -File {DC_USER_HOME}/ExportUsers.ps1'"
-    run_ssh_with_retry(ssh_cmd)
-    
+    run_ssh_with_retry(ssh_argv(f'powershell -ExecutionPolicy Bypass -File {DC_USER_HOME}/export_users.ps1'))
+
     # 下载结果
     print("正在下载结果...")
     output_file = get_output_path('ad_users.csv')
-    scp_cmd = f"sshpass -p '{DC_PASSWORD}' scp -o ControlPath={SSH_CONTROL_PATH} {DC_USER}@{DC_HOST}:~/ExportedUsers.csv {output_file}"
-    result = run_scp_with_retry(scp_cmd)
+    result = run_scp_with_retry(scp_download_argv('~/ExportedUsers.csv', output_file))
     
     if result.returncode != 0:
         print("✗ 下载文件失败")
         sys.exit(1)
     
-    # 统计用户数
-    with open(output_file, 'r', encoding='utf-8-sig') as f:
-        reader = csv.reader(f)
-        user_count = sum(1 for row in reader) - 1
+    # 统计用户数（按字节扫描换行符，避免逐字段解析整个CSV）
+    user_count = count_csv_rows(output_file)
     
     print(f"✓ 已导出 {user_count} 个用户到 {output_file}")
+
+    # 可选：转换为Parquet供下游反复读取（AD_EXPORT_PARQUET=true 开启）
+    if os.getenv("AD_EXPORT_PARQUET", "false").lower() == "true":
+        convert_csv_to_parquet(output_file)
+
     print("\n" + "=" * 60)
     print("完成")
     print("=" * 60)
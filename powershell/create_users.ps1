@@ -39,9 +39,16 @@ $failureCount = 0
 $passwords = @()
 $failures = @()
 
+# 密码字符集在循环外构建一次（每用户重建数组纯属浪费）
+$upperCase = [char[]]'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+$lowerCase = [char[]]'abcdefghijklmnopqrstuvwxyz'
+$numbers = [char[]]'0123456789'
+$specialChars = [char[]]'!@#$%^&*()-_=+[]{}|;:",.<>/?'
+$allChars = $upperCase + $lowerCase + $numbers + $specialChars
+
 try {
     $users = Import-Csv -Path $csvPath -Encoding UTF8
-    
+
     foreach ($user in $users) {
         # 确保所有属性都是字符串类型
         $samAccountName = [string]$user.SamAccountName
@@ -65,18 +72,12 @@ try {
         }
         
         # 生成随机密码（包含大小写字母、数字和特殊字符）
-        $upperCase = [char[]]'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
-        $lowerCase = [char[]]'abcdefghijklmnopqrstuvwxyz'
-        $numbers = [char[]]'0123456789'
-        $specialChars = [char[]]'!@#$%^&*()-_=+[]{}|;:",.<>/?'
-        
         $passwordBuilder = [System.Text.StringBuilder]::new()
         $passwordBuilder.Append(($upperCase | Get-Random)) | Out-Null
         $passwordBuilder.Append(($lowerCase | Get-Random)) | Out-Null
         $passwordBuilder.Append(($numbers | Get-Random)) | Out-Null
         $passwordBuilder.Append(($specialChars | Get-Random)) | Out-Null
-        
-        $allChars = $upperCase + $lowerCase + $numbers + $specialChars
+
         for ($i = 4; $i -lt 12; $i++) {
             $passwordBuilder.Append(($allChars | Get-Random)) | Out-Null
         }
@@ -171,6 +172,9 @@ try {
     if ($failureCount -gt 0) {
         Write-Host "处理失败: $failureCount 个用户" -ForegroundColor Red
     }
+
+    # 末尾输出结构化结果行，Python端直接解析，不依赖上面的中文输出格式
+    Write-Output ("##RESULT##" + (ConvertTo-Json -Compress @{ success = $successCount; failed = $failureCount }))
 }
 catch {
     Write-Host "错误: $_" -ForegroundColor Red
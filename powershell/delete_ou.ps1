@@ -145,6 +145,9 @@ try {
     Write-Host "成功删除: $successCount 个 OU" -ForegroundColor Green
     Write-Host "跳过: $skippedCount 个 OU" -ForegroundColor Yellow
     Write-Host "失败: $failedCount 个 OU" -ForegroundColor Red
+
+    # 末尾输出结构化结果行，Python端直接解析，不依赖上面的中文输出格式
+    Write-Output ("##RESULT##" + (ConvertTo-Json -Compress @{ success = $successCount; failed = $failedCount; skipped = $skippedCount }))
 }
 catch {
     Write-Host "错误: $_" -ForegroundColor Red
@@ -0,0 +1,84 @@
+# 导入Active Directory模块（只导入一次，OU和用户共用同一会话）
+Import-Module ActiveDirectory
+
+# 设置输出编码为 UTF-8（支持中英文版 Windows）
+[Console]::OutputEncoding = [System.Text.Encoding]::UTF8
+
+# 加载配置文件（使用 UTF-8 编码）
+$configPath = "$env:USERPROFILE\dc_config.ps1"
+if (Test-Path $configPath) {
+    $configContent = [System.IO.File]::ReadAllText($configPath, [System.Text.Encoding]::UTF8)
+    Invoke-Expression $configContent
+} else {
+    Write-Error "配置文件不存在: $configPath"
+    exit 1
+}
+
+# 使用配置文件中的变量
+$BaseOU = $DC_BASE_OU
+$ExcludeOU = $DC_EXCLUDE_OU
+
+# 设置导出的CSV文件路径
+$ouCsvPath = "$env:USERPROFILE\ExistingOUs.csv"
+$userCsvPath = "$env:USERPROFILE\ExportedUsers.csv"
+
+try {
+    # 导出OU列表（在服务端过滤基础OU本身和排除OU子树，减少传输行数）
+    if ([string]::IsNullOrEmpty($BaseOU)) {
+        $ous = Get-ADOrganizationalUnit -Filter * | Select-Object Name, DistinguishedName
+    } else {
+        $ous = Get-ADOrganizationalUnit -Filter * -SearchBase $BaseOU | Select-Object Name, DistinguishedName
+    }
+    if ([string]::IsNullOrEmpty($ExcludeOU)) {
+        $countedOus = @($ous | Where-Object { $_.DistinguishedName -ne $BaseOU })
+    } else {
+        $countedOus = @($ous | Where-Object {
+            $_.DistinguishedName -ne $BaseOU -and
+            $_.DistinguishedName -ne $ExcludeOU -and
+            $_.DistinguishedName -notlike "*,$ExcludeOU"
+        })
+    }
+    if ($countedOus) {
+        $countedOus | Export-Csv -Path $ouCsvPath -NoTypeInformation -Encoding UTF8
+    }
+
+    # 获取所有域用户（包括禁用的）
+    if ([string]::IsNullOrEmpty($BaseOU)) {
+        $users = Get-ADUser -Filter * -Properties SamAccountName, EmailAddress, Mobile, EmployeeID, EmployeeNumber, info, DisplayName, Enabled, DistinguishedName
+    } else {
+        $users = Get-ADUser -Filter * -SearchBase $BaseOU -Properties SamAccountName, EmailAddress, Mobile, EmployeeID, EmployeeNumber, info, DisplayName, Enabled, DistinguishedName
+    }
+
+    # 排除指定 OU，但离职员工 OU 总是包含
+    if ([string]::IsNullOrEmpty($ExcludeOU)) {
+        $filteredUsers = @($users)
+    } else {
+        $filteredUsers = @($users | Where-Object {
+            ($_.DistinguishedName -notlike "*$ExcludeOU") -or ($_.DistinguishedName -like "*$DC_RESIGNED_OU*")
+        })
+    }
+
+    if ($filteredUsers) {
+        # 导出到CSV
+        $filteredUsers | Select-Object SamAccountName, EmailAddress, Mobile, EmployeeID, EmployeeNumber, info, DisplayName, Enabled, DistinguishedName |
+            Export-Csv -Path $userCsvPath -NoTypeInformation -Encoding UTF8
+
+        Write-Host "成功导出 $($filteredUsers.Count) 个用户（已排除指定 OU）" -ForegroundColor Green
+    } else {
+        Write-Host "未找到用户" -ForegroundColor Yellow
+    }
+
+    # 两个CSV打包为一个压缩包，客户端单次下载（DN后缀高度重复，压缩率高）
+    $dumpPaths = @($ouCsvPath, $userCsvPath) | Where-Object { Test-Path $_ }
+    if ($dumpPaths) {
+        Compress-Archive -Force -Path $dumpPaths -DestinationPath "$env:USERPROFILE\ad_dump.zip"
+    }
+
+    # 输出数量统计，Python 端直接解析，省掉单独的统计查询
+    Write-Output "OU_COUNT=$($countedOus.Count)"
+    Write-Output "USER_COUNT=$($filteredUsers.Count)"
+}
+catch {
+    Write-Host "错误: $_" -ForegroundColor Red
+    exit 1
+}
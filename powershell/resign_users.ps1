@@ -58,6 +58,9 @@ try {
     Write-Host "`n===== 处理完成 =====" -ForegroundColor Cyan
     Write-Host "成功: $successCount 个用户" -ForegroundColor Green
     Write-Host "失败: $failedCount 个用户" -ForegroundColor Red
+
+    # 末尾输出结构化结果行，Python端直接解析，不依赖上面的中文输出格式
+    Write-Output ("##RESULT##" + (ConvertTo-Json -Compress @{ success = $successCount; failed = $failedCount }))
 }
 catch {
     Write-Host "错误: $_" -ForegroundColor Red
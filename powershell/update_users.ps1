@@ -41,7 +41,21 @@ $successes = @()
 
 try {
     $users = Import-Csv -Path $csvPath -Encoding UTF8
-    
+
+    # 一次性预取域用户和OU到哈希表，替代循环内每用户一次的LDAP查询往返
+    $prefetchProps = 'DisplayName', 'EmailAddress', 'EmployeeID', 'EmployeeNumber', 'info', 'Enabled'
+    if ([string]::IsNullOrEmpty($BaseOU)) {
+        $prefetchedUsers = Get-ADUser -Filter * -Properties $prefetchProps
+        $prefetchedOus = Get-ADOrganizationalUnit -Filter *
+    } else {
+        $prefetchedUsers = Get-ADUser -Filter * -SearchBase $BaseOU -Properties $prefetchProps
+        $prefetchedOus = Get-ADOrganizationalUnit -Filter * -SearchBase $BaseOU
+    }
+    $adUserMap = @{}
+    foreach ($u in $prefetchedUsers) { $adUserMap[$u.SamAccountName] = $u }
+    $ouSet = @{}
+    foreach ($o in $prefetchedOus) { $ouSet[$o.DistinguishedName] = $true }
+
     foreach ($user in $users) {
         # 确保所有属性都是字符串类型
         $samAccountName = [string]$user.SamAccountName
@@ -62,8 +76,11 @@ try {
         }
         
         try {
-            # 获取现有用户
-            $adUser = Get-ADUser -Identity $samAccountName -Properties DisplayName, EmailAddress, EmployeeID, EmployeeNumber, info, Enabled -ErrorAction Stop
+            # 从预取结果中取现有用户（预取范围外的用户退回单次查询）
+            $adUser = $adUserMap[$samAccountName]
+            if ($null -eq $adUser) {
+                $adUser = Get-ADUser -Identity $samAccountName -Properties $prefetchProps -ErrorAction Stop
+            }
             
             # 准备更新参数
             $updateParams = @{Identity = $adUser.DistinguishedName}
@@ -124,16 +141,18 @@ try {
                     if ($updateParams.Count -gt 1) {
                         Set-ADUser @updateParams
                     }
-                    # 再移动OU
+                    # 再移动OU（目标OU存在性查预取的哈希表，不再逐个查询AD）
                     if ($needMove) {
-                        try {
-                            # 检查目标OU是否存在
-                            $targetOU = Get-ADOrganizationalUnit -Identity $expectedOUPath -ErrorAction Stop
-                            # 重新获取用户DN（可能在Set-ADUser后已更新）
-                            $currentUser = Get-ADUser -Identity $samAccountName -Properties DistinguishedName
-                            Move-ADObject -Identity $currentUser.DistinguishedName -TargetPath $expectedOUPath -ErrorAction Stop
-                        } catch {
-                            Write-Host "  ⚠ OU移动失败: $_ (目标OU: $expectedOUPath)" -ForegroundColor Yellow
+                        if ($ouSet.ContainsKey($expectedOUPath)) {
+                            try {
+                                # 重新获取用户DN（可能在Set-ADUser后已更新）
+                                $currentUser = Get-ADUser -Identity $samAccountName -Properties DistinguishedName
+                                Move-ADObject -Identity $currentUser.DistinguishedName -TargetPath $expectedOUPath -ErrorAction Stop
+                            } catch {
+                                Write-Host "  ⚠ OU移动失败: $_ (目标OU: $expectedOUPath)" -ForegroundColor Yellow
+                            }
+                        } else {
+                            Write-Host "  ⚠ OU移动失败: 目标OU不存在 ($expectedOUPath)" -ForegroundColor Yellow
                         }
                     }
                     Write-Host "✓ 更新成功: $samAccountName $displayName ($changesList)" -ForegroundColor Green
@@ -194,6 +213,9 @@ try {
     if ($failureCount -gt 0) {
         Write-Host "处理失败: $failureCount 个用户" -ForegroundColor Red
     }
+
+    # 末尾输出结构化结果行，Python端直接解析，不依赖上面的中文输出格式
+    Write-Output ("##RESULT##" + (ConvertTo-Json -Compress @{ success = $successCount; failed = $failureCount; skipped = $skippedCount }))
 }
 catch {
     Write-Host "错误: $_" -ForegroundColor Red
@@ -1,8 +1,15 @@
+import copy
+import functools
 import smtplib
 import os
 import html
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from email.message import EmailMessage
 from dotenv import load_dotenv
 from datetime import datetime
 
@@ -10,48 +17,105 @@ from datetime import datetime
 script_dir = os.path.dirname(os.path.abspath(__file__))
 load_dotenv(os.path.join(script_dir, '.env'))
 
-def send_password_email(receiver_email, new_password, sam_account='', display_name='', department=''):
-    # 邮件配置（从环境变量读取）
+# 单个SMTP连接最多发送的邮件数，超过后重建连接（避免触发服务器限制）
+MAX_MESSAGES_PER_CONNECTION = 1000
+
+# 连接闲置超过该秒数后，复用前先用NOOP探活（服务器可能已静默断开）
+SMTP_IDLE_PROBE_SECONDS = 60
+
+# 邮箱地址格式校验（发送前拦截明显无效的地址，省掉一次SMTP往返）
+_EMAIL_RE = re.compile(r"[^@\s]+@[^@\s]+\.[^@\s]+")
+
+# 本次运行中被服务器硬退回的地址，后续同地址直接跳过网络发送
+_HARD_BOUNCED = set()
+_HARD_BOUNCED_LOCK = threading.Lock()
+
+
+class _RateLimiter:
+    """令牌桶限速器：跨线程限制每秒发出的邮件数，避免触发服务商限流
+
+    rate <= 0 表示不限速。
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """阻塞直到取得一个令牌"""
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# 全局发送限速（每秒邮件数），由 EMAIL_RATE_LIMIT 环境变量控制，默认不限速
+_RATE_LIMITER = _RateLimiter(float(os.getenv("EMAIL_RATE_LIMIT", "0")))
+
+
+def _extract_login_email(sender_email):
+    """提取登录用的纯邮箱地址（如果 sender_email 包含显示名称）"""
+    if sender_email and '<' in sender_email and '>' in sender_email:
+        return sender_email.split('<')[1].split('>')[0].strip()
+    return sender_email
+
+
+@dataclass(frozen=True)
+class MailConfig:
+    """邮件配置（模块加载时从环境变量读取一次）"""
+    sender_email: str
+    sender_password: str
+    smtp_server: str
+    smtp_port: int
+    bcc_emails: str
+    additional_content: str
+    login_email: str
+
+
+def _load_mail_config():
+    """从环境变量构建邮件配置"""
     sender_email = os.getenv("EMAIL_SENDER")
-    sender_password = os.getenv("EMAIL_PASSWORD")
-    smtp_server = os.getenv("EMAIL_SMTP_SERVER")
-    smtp_port = int(os.getenv("EMAIL_SMTP_PORT", "465"))
-    bcc_emails = os.getenv("EMAIL_BCC", "").strip()
-    additional_content = os.getenv("EMAIL_ADDITIONAL_CONTENT", "").strip()
-    
-    # 提取登录用的纯邮箱地址（如果 sender_email 包含显示名称）
-    if '<' in sender_email and '>' in sender_email:
-        login_email = sender_email.split('<')[1].split('>')[0].strip()
-    else:
-        login_email = sender_email
-
-    # 检查配置
-    if not all([sender_email, sender_password, smtp_server]):
-        return False, "邮件配置不完整，请检查 .env 文件"
-
-    # 获取当前日期
-    current_date = datetime.now().strftime("%Y年%m月%d日")
-    
-    # 处理空部门
-    if not department or department.strip() == '':
-        department = '（未分配部门）'
+    return MailConfig(
+        sender_email=sender_email,
+        sender_password=os.getenv("EMAIL_PASSWORD"),
+        smtp_server=os.getenv("EMAIL_SMTP_SERVER"),
+        smtp_port=int(os.getenv("EMAIL_SMTP_PORT", "465")),
+        bcc_emails=os.getenv("EMAIL_BCC", "").strip(),
+        additional_content=os.getenv("EMAIL_ADDITIONAL_CONTENT", "").strip(),
+        login_email=_extract_login_email(sender_email),
+    )
+
+
+_CONFIG = _load_mail_config()
+
 
-    # HTML 邮件内容
-    html_body = f"""
+# HTML邮件固定头部（CSS和页头不随收件人变化，不参与占位符替换）
+_HEAD_HTML = """
     <!DOCTYPE html>
     <html>
     <head>
         <meta charset="UTF-8">
         <style>
-            body {{ font-family: Arial, 'Microsoft YaHei', sans-serif; line-height: 1.6; color: #333; }}
-            .container {{ max-width: 100vw; margin: 20px auto; padding: 20px; border: 1px solid #ddd; border-radius: 5px; }}
-            .header {{ background-color: #4CAF50; color: white; padding: 5px; border-radius: 5px 5px 0 0; text-align: center; }}
-            .content {{ padding: 20px; background-color: #f9f9f9; }}
-            .info-box {{ background-color: white; padding: 15px; margin: 15px 0; border-left: 4px solid #4CAF50; }}
-            .footer {{ margin-top: 20px; padding-top: 15px; border-top: 1px solid #ddd; font-size: 12px; color: #666; }}
-            table {{ width: 100%; border-collapse: collapse; }}
-            td {{ padding: 8px; }}
-            .label {{ font-weight: bold; width: 100px; }}
+            body { font-family: Arial, 'Microsoft YaHei', sans-serif; line-height: 1.6; color: #333; }
+            .container { max-width: 100vw; margin: 20px auto; padding: 20px; border: 1px solid #ddd; border-radius: 5px; }
+            .header { background-color: #4CAF50; color: white; padding: 5px; border-radius: 5px 5px 0 0; text-align: center; }
+            .content { padding: 20px; background-color: #f9f9f9; }
+            .info-box { background-color: white; padding: 15px; margin: 15px 0; border-left: 4px solid #4CAF50; }
+            .footer { margin-top: 20px; padding-top: 15px; border-top: 1px solid #ddd; font-size: 12px; color: #666; }
+            table { width: 100%; border-collapse: collapse; }
+            td { padding: 8px; }
+            .label { font-weight: bold; width: 100px; }
         </style>
     </head>
     <body>
@@ -59,10 +123,21 @@ def send_password_email(receiver_email, new_password, sam_account='', display_na
             <div class="header">
                 <h2>域账号密码通知</h2>
             </div>
-            <div class="content">
+            <div class="content">"""
+
+# HTML邮件固定尾部
+_FOOT_HTML = """
+            </div>
+        </div>
+    </body>
+    </html>
+    """
+
+# 随收件人变化的中间部分（仅这段参与占位符替换）
+_BODY_TEMPLATE = """
                 <p>您好，<strong>{display_name}</strong>：</p>
                 <p>您的域账号已创建，以下是您的登录信息：</p>
-                
+
                 <div class="info-box">
                     <table>
                         <tr>
@@ -83,49 +158,254 @@ def send_password_email(receiver_email, new_password, sam_account='', display_na
                         </tr>
                         <tr>
                             <td class="label">密码：</td>
-                            <td>{html.escape(new_password)}</td>
+                            <td>{new_password}</td>
                         </tr>
                     </table>
                 </div>
-                
+
                 <p><strong>重要提示：</strong></p>
                 <ul>
                     <li>请妥善保管您的密码，不要与他人分享</li>
                 </ul>
-                
+
                 {additional_content}
-                
+
                 <div class="footer">
                     <p>此邮件由系统自动发送，请勿回复。</p>
                     <p>发送时间：{current_date}</p>
-                </div>
-            </div>
-        </div>
-    </body>
-    </html>
+                </div>"""
+
+
+@functools.lru_cache(maxsize=512)
+def _render_body(receiver_email, new_password, sam_account, display_name, department, additional_content, current_date):
+    """渲染HTML正文并缓存：重试或同批次重复的收件人直接命中缓存
+
+    缓存内容含明文密码，批次结束后必须调用 cache_clear() 清空。
     """
+    return _HEAD_HTML + _BODY_TEMPLATE.format_map({
+        "display_name": html.escape(display_name),
+        "sam_account": html.escape(sam_account),
+        "receiver_email": html.escape(receiver_email),
+        "department": html.escape(department),
+        "new_password": html.escape(new_password),
+        "current_date": current_date,
+        "additional_content": additional_content,
+    }) + _FOOT_HTML
 
-    try:
-        # 创建邮件对象
-        message = MIMEMultipart("alternative")
-        message["Subject"] = "域账号密码通知"
-        message["From"] = sender_email
+
+def _build_html_body(receiver_email, new_password, sam_account, display_name, department, additional_content):
+    """构建HTML邮件正文（用户数据做HTML转义，防止破坏页面结构）
+
+    固定的头尾直接拼接，只有中间的收件人信息段做占位符替换。
+    """
+    current_date = datetime.now().strftime("%Y年%m月%d日")
+    return _render_body(receiver_email, new_password, sam_account,
+                        display_name, department, additional_content, current_date)
+
+
+class PasswordMailer:
+    """批量发送密码邮件的SMTP客户端。
+
+    复用单个 SMTP_SSL 连接：只握手和登录一次，之后循环调用 send()，
+    每发送 MAX_MESSAGES_PER_CONNECTION 封或连接断开时自动重建连接。
+    用法：
+        with PasswordMailer() as mailer:
+            for row in rows:
+                mailer.send(...)
+    """
+
+    def __init__(self, config=None):
+        # 邮件配置（默认使用模块加载时冻结的配置）
+        cfg = config or _CONFIG
+        self.sender_email = cfg.sender_email
+        self.sender_password = cfg.sender_password
+        self.smtp_server = cfg.smtp_server
+        self.smtp_port = cfg.smtp_port
+        self.bcc_emails = cfg.bcc_emails
+        self.additional_content = cfg.additional_content
+        self.login_email = cfg.login_email
+
+        self.server = None
+        self.sent_count = 0
+        self._last_used = 0.0
+
+        # 预构建邮件骨架：主题/发件人/密送在整个批次中不变，逐封只补To和正文
+        self._base_message = EmailMessage()
+        self._base_message["Subject"] = "域账号密码通知"
+        self._base_message["From"] = self.sender_email
+        if self.bcc_emails:
+            self._base_message["Bcc"] = self.bcc_emails
+
+    def _clone_base_message(self):
+        """克隆邮件骨架（头部列表和正文须独立，避免跨邮件串改）"""
+        message = copy.copy(self._base_message)
+        message._headers = self._base_message._headers[:]
+        message._payload = None
+        return message
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def _connect(self):
+        """建立SMTP连接并登录"""
+        self.server = smtplib.SMTP_SSL(self.smtp_server, self.smtp_port, timeout=30)
+        self.server.login(self.login_email, self.sender_password)
+        self._last_used = time.monotonic()
+
+    def _reconnect(self):
+        """关闭旧连接并重新建立"""
+        self.close()
+        self._connect()
+
+    def close(self):
+        """关闭SMTP连接"""
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except Exception:
+                pass
+            self.server = None
+
+    def _build_message(self, receiver_email, new_password, sam_account, display_name, department):
+        """构建邮件对象（基于预构建的骨架，仅补收件人和正文）"""
+        message = self._clone_base_message()
         message["To"] = receiver_email
-        
-        # 添加密送
-        if bcc_emails:
-            message["Bcc"] = bcc_emails
-        
+
+        html_body = _build_html_body(receiver_email, new_password, sam_account,
+                                     display_name, department, self.additional_content)
+
         # 添加HTML内容
-        html_part = MIMEText(html_body, "html", "utf-8")
-        message.attach(html_part)
-        
-        # 发送邮件
-        with smtplib.SMTP_SSL(smtp_server, smtp_port) as server:
-            server.login(login_email, sender_password)
-            server.send_message(message)
-        
-        return True, "发送成功"
-    
-    except Exception as e:
-        return False, str(e)
+        message.set_content(html_body, subtype="html", charset="utf-8")
+        return message
+
+    def send(self, receiver_email, new_password, sam_account='', display_name='', department=''):
+        """发送单封密码邮件，复用已有连接"""
+        # 检查配置
+        if not all([self.sender_email, self.sender_password, self.smtp_server]):
+            return False, "邮件配置不完整，请检查 .env 文件"
+
+        # 校验收件地址，无效地址不消耗SMTP往返
+        receiver_email = (receiver_email or '').strip()
+        if not _EMAIL_RE.fullmatch(receiver_email):
+            return False, "邮箱地址格式无效"
+
+        with _HARD_BOUNCED_LOCK:
+            if receiver_email in _HARD_BOUNCED:
+                return False, "邮箱地址此前被服务器拒收，已跳过"
+
+        # 处理空部门
+        if not department or department.strip() == '':
+            department = '（未分配部门）'
+
+        try:
+            if self.server is None:
+                self._connect()
+            elif time.monotonic() - self._last_used > SMTP_IDLE_PROBE_SECONDS:
+                # 连接闲置较久，先探活；服务器已断开则重连
+                try:
+                    self.server.noop()
+                except Exception:
+                    self._reconnect()
+
+            message = self._build_message(receiver_email, new_password, sam_account,
+                                          display_name, department)
+
+            # 全局限速：所有工作线程共享同一个令牌桶
+            _RATE_LIMITER.acquire()
+
+            try:
+                self.server.send_message(message)
+            except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError):
+                # 连接断开，重连后重试一次
+                self._reconnect()
+                self.server.send_message(message)
+
+            self.sent_count += 1
+            self._last_used = time.monotonic()
+            # 定期重建连接，避免单连接发送过多被服务器限流
+            if self.sent_count % MAX_MESSAGES_PER_CONNECTION == 0:
+                self._reconnect()
+
+            return True, "发送成功"
+
+        except smtplib.SMTPRecipientsRefused as e:
+            # 记录被拒收的地址，同批次内重复出现时直接跳过
+            with _HARD_BOUNCED_LOCK:
+                _HARD_BOUNCED.add(receiver_email)
+            return False, str(e)
+        except Exception as e:
+            return False, str(e)
+
+
+def send_password_emails_bulk(rows, max_workers=None):
+    """并发批量发送密码邮件，返回 [(row, success, message), ...]
+
+    每个工作线程复用池中一个已认证的SMTP连接，发送是I/O等待为主，
+    线程数越多越接近线性加速（受服务商并发连接上限约束）。
+    并发数由 EMAIL_MAX_CONCURRENCY 环境变量控制（默认4）。
+    """
+    if not rows:
+        return []
+
+    if max_workers is None:
+        max_workers = int(os.getenv("EMAIL_MAX_CONCURRENCY", "4"))
+    max_workers = max(1, min(max_workers, len(rows)))
+
+    # 预建连接池（队列大小 = 工作线程数）
+    mailers = queue.Queue()
+    for _ in range(max_workers):
+        mailers.put(PasswordMailer())
+
+    def _send_one(row):
+        mailer = mailers.get()
+        try:
+            success, message = mailer.send(
+                receiver_email=row['receiver_email'],
+                new_password=row['new_password'],
+                sam_account=row.get('sam_account', ''),
+                display_name=row.get('display_name', ''),
+                department=row.get('department', '')
+            )
+            # 服务器限流（421/450）时稍作等待再重试一次
+            if not success and ('421' in message or '450' in message):
+                time.sleep(5)
+                success, message = mailer.send(
+                    receiver_email=row['receiver_email'],
+                    new_password=row['new_password'],
+                    sam_account=row.get('sam_account', ''),
+                    display_name=row.get('display_name', ''),
+                    department=row.get('department', '')
+                )
+            return success, message
+        finally:
+            mailers.put(mailer)
+
+    results = []
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(_send_one, row): row for row in rows}
+            for future in as_completed(futures):
+                row = futures[future]
+                try:
+                    success, message = future.result()
+                except Exception as e:
+                    success, message = False, str(e)
+                results.append((row, success, message))
+    finally:
+        # 关闭池中所有连接
+        while not mailers.empty():
+            mailers.get_nowait().close()
+        # 清空正文缓存，避免明文密码长期驻留内存
+        _render_body.cache_clear()
+
+    return results
+
+
+def send_password_email(receiver_email, new_password, sam_account='', display_name='', department=''):
+    """发送单封密码邮件（每次调用建立一次SMTP连接，批量发送请使用 PasswordMailer）"""
+    with PasswordMailer() as mailer:
+        return mailer.send(receiver_email, new_password, sam_account, display_name, department)
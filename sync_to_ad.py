@@ -1,10 +1,19 @@
 #!/usr/bin/env python3
+import base64
 import csv
+import functools
+import hashlib
+import json
 import subprocess
 import os
 import sys
+import random
 import re
 import time
+import zipfile
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 from datetime import datetime
 from dotenv import load_dotenv
 
@@ -38,12 +47,35 @@ def get_ps_path(filename):
     """获取powershell目录下文件的绝对路径"""
     return os.path.join(SCRIPT_DIR, 'powershell', filename)
 
+@functools.lru_cache(maxsize=32)
+def detect_csv_encoding(path, sample=8192):
+    """探测CSV文件编码：读一段前缀，按BOM判断，无BOM时试解码
+
+    用于从域控下载的文件（导出脚本固定UTF-8，但老版本Windows工具
+    可能以UTF-16或GBK落盘）。本地生成的文件编码已知，不必探测。
+    结果按路径缓存（每个文件单次运行内只下载一次，不会中途换编码）。
+    """
+    with open(path, 'rb') as f:
+        raw = f.read(sample)
+    if raw.startswith(b'\xef\xbb\xbf'):
+        return 'utf-8-sig'
+    if raw.startswith(b'\xff\xfe') or raw.startswith(b'\xfe\xff'):
+        return 'utf-16'
+    try:
+        raw.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError:
+        # 中文版Windows的传统默认编码
+        return 'gbk'
+
 # 加载环境变量
 load_dotenv(os.path.join(SCRIPT_DIR, '.env'))
 
 # 检查 sshpass 是否安装
 def check_sshpass():
-    """检查 sshpass 是否已安装"""
+    """检查 sshpass 是否已安装（配置了SSH密钥认证时不需要）"""
+    if os.getenv("DC_SSH_KEY", "").strip():
+        return
     try:
         result = subprocess.run(['which', 'sshpass'], capture_output=True)
         if result.returncode != 0:
@@ -60,11 +92,16 @@ def check_sshpass():
 
 check_sshpass()
 
+# 输出解析用的正则在模块加载时编译一次（每次脚本执行都会用到）
+# 匹配OU变更模式: OU: 'OU=xxx,OU=yyy,...' -> 'OU=aaa,OU=bbb,...'
+_RE_OU_CHANGE = re.compile(r"OU: '([^']+)' -> '([^']+)'")
+# 脚本输出中的处理数量（##RESULT##行缺失时的兜底提取）
+_RE_COUNT_DRYRUN = re.compile(r'将(?:更新|创建): (\d+) 个用户')
+_RE_COUNT_LIVE = re.compile(r'成功: (\d+) 个用户')
+
 def format_ou_display(detail_text):
     """转换OU显示格式为更易读的格式"""
-    # 匹配OU变更模式: OU: 'OU=xxx,OU=yyy,...' -> 'OU=aaa,OU=bbb,...'
-    ou_pattern = r"OU: '([^']+)' -> '([^']+)'"
-    match = re.search(ou_pattern, detail_text)
+    match = _RE_OU_CHANGE.search(detail_text)
     
     if match:
         old_ou = match.group(1)
@@ -110,6 +147,8 @@ def filter_info_changes(changes_text):
 DC_HOST = os.getenv("DC_HOST")
 DC_USER = os.getenv("DC_USER")
 DC_PASSWORD = os.getenv("DC_PASSWORD")
+# SSH私钥路径（可选）：配置后走密钥认证，不再经过 sshpass 传密码
+DC_SSH_KEY = os.getenv("DC_SSH_KEY", "").strip()
 DC_DOMAIN = os.getenv("DC_DOMAIN")
 DC_BASE_OU = os.getenv("DC_BASE_OU", "")
 DC_EXCLUDE_OU = os.getenv("DC_EXCLUDE_OU", "")
@@ -119,28 +158,15 @@ DC_RESIGNED_OU = os.getenv("DC_RESIGNED_OU", "")
 DC_USER_HOME = None
 
 # SSH ControlMaster 配置
-SSH_CONTROL_PATH = "/tmp/ssh-feishu-ad-sync-%r@%h:%p"
-SSH_CONTROL_MASTER_INITIALIZED = False
-
-def init_ssh_control_master():
-    """初始化SSH ControlMaster连接"""
-    global SSH_CONTROL_MASTER_INITIALIZED
-    
-    if SSH_CONTROL_MASTER_INITIALIZED:
-        return
-    
-    # 建立主连接（后台运行，保持5分钟）
-    cmd = f"sshpass -p '{DC_PASSWORD}' ssh -o StrictHostKeyChecking=no -o ControlMaster=yes -o ControlPath={SSH_CONTROL_PATH} -o ControlPersist=5m -fN {DC_USER}@{DC_HOST}"
-    try:
-        subprocess.run(cmd, shell=True, capture_output=True, timeout=10)
-        SSH_CONTROL_MASTER_INITIALIZED = True
-    except:
-        pass
+# ControlMaster=auto 由第一次调用自动建立主连接、后续调用附着，无需单独的引导步骤；
+# %C 是连接参数的哈希，避免长主机名超出Unix套接字路径长度限制
+SSH_CONTROL_PATH = "/tmp/ssh-feishu-ad-sync-%C"
 
 def cleanup_ssh_control_master():
     """清理SSH ControlMaster连接"""
-    cmd = f"ssh -o StrictHostKeyChecking=no -o ControlPath={SSH_CONTROL_PATH} -O exit {DC_USER}@{DC_HOST} 2>/dev/null"
-    subprocess.run(cmd, shell=True, capture_output=True)
+    cmd = ["ssh", "-o", "StrictHostKeyChecking=no", "-o", f"ControlPath={SSH_CONTROL_PATH}",
+           "-O", "exit", f"{DC_USER}@{DC_HOST}"]
+    subprocess.run(cmd, capture_output=True)
 
 def init_dc_user_home():
     """初始化域控制器用户主目录路径"""
@@ -148,15 +174,11 @@ def init_dc_user_home():
     
     if DC_USER_HOME:
         return DC_USER_HOME
-    
-    # 初始化SSH主连接
-    init_ssh_control_master()
-    
+
     try:
-        cmd = f"sshpass -p '{DC_PASSWORD}' ssh -o StrictHostKeyChecking=no -o ControlPath={SSH_CONTROL_PATH} {DC_USER}@{DC_HOST} 'powershell -Command \"echo $env:USERPROFILE\"'"
-        result = run_ssh_with_retry(cmd, timeout=10)
+        result = run_on_dc('powershell -Command "echo $env:USERPROFILE"', timeout=10)
         if result.returncode == 0:
-            DC_USER_HOME = result.stdout.decode('utf-8').strip().replace('\\', '/')
+            DC_USER_HOME = result.stdout.strip().replace('\\', '/')
             return DC_USER_HOME
     except:
         pass
@@ -164,43 +186,150 @@ def init_dc_user_home():
     print(f"✗ 无法获取域控制器用户主目录")
     sys.exit(1)
 
-def run_ssh_with_retry(cmd, max_retries=3, timeout=30, decode=True):
-    """执行SSH命令，带重试机制"""
+# 不可重试的SSH错误（认证/主机密钥问题，重试只会浪费时间）
+SSH_FATAL_ERRORS = ('Permission denied', 'Host key verification failed')
+
+def _retry_delay(attempt):
+    """指数退避 + 随机抖动，避免多个客户端同步重试"""
+    return min(30, 0.5 * (2 ** attempt)) + random.random() * 0.5
+
+def _is_fatal_ssh_error(result):
+    """判断是否为不可恢复的SSH错误"""
+    stderr = result.stderr or b''
+    if isinstance(stderr, bytes):
+        stderr = stderr.decode('utf-8', errors='replace')
+    return any(err in stderr for err in SSH_FATAL_ERRORS)
+
+def run_ssh_with_retry(argv, max_retries=3, timeout=30, decode=True):
+    """执行SSH命令（argv列表形式），带重试机制（指数退避，认证失败立即返回）
+
+    decode=True 时子进程以文本模式运行，stdout/stderr 直接是 str
+    （UTF-8，非法字节替换），调用方无需再手动 decode。
+    """
+    run_kwargs = {'capture_output': True, 'timeout': timeout}
+    if decode:
+        run_kwargs.update(encoding='utf-8', errors='replace')
     for attempt in range(max_retries):
         try:
-            result = subprocess.run(cmd, shell=True, capture_output=True, timeout=timeout)
-            if result.returncode == 0:
+            result = subprocess.run(argv, **run_kwargs)
+            if result.returncode == 0 or _is_fatal_ssh_error(result):
                 return result
             if attempt < max_retries - 1:
-                time.sleep(2)
+                time.sleep(_retry_delay(attempt))
         except subprocess.TimeoutExpired:
             if attempt < max_retries - 1:
-                time.sleep(2)
+                time.sleep(_retry_delay(attempt))
             else:
                 raise
         except Exception as e:
             if attempt < max_retries - 1:
-                time.sleep(2)
+                time.sleep(_retry_delay(attempt))
             else:
                 raise
     return result
 
-def run_scp_with_retry(cmd, max_retries=3):
-    """执行SCP命令，带重试机制"""
+def run_scp_with_retry(argv, max_retries=3):
+    """执行SCP命令（argv列表形式），带重试机制（指数退避，认证失败立即返回）"""
     for attempt in range(max_retries):
         try:
-            result = subprocess.run(cmd, shell=True, capture_output=True)
-            if result.returncode == 0:
+            result = subprocess.run(argv, capture_output=True)
+            if result.returncode == 0 or _is_fatal_ssh_error(result):
                 return result
             if attempt < max_retries - 1:
-                time.sleep(2)
+                time.sleep(_retry_delay(attempt))
         except Exception as e:
             if attempt < max_retries - 1:
-                time.sleep(2)
+                time.sleep(_retry_delay(attempt))
             else:
                 raise
     return result
 
+# SSH/SCP参数前缀在模块加载时拼好（同一DC整个运行期不变，无需逐调用重拼）
+# argv列表直接交给exec，不经过/bin/sh解析，密码含特殊字符也安全
+# 认证方式：配置了 DC_SSH_KEY 走密钥（BatchMode拒绝任何交互提问），
+# 否则由 sshpass 传入密码
+if DC_SSH_KEY:
+    _SSH_AUTH = ["ssh", "-i", os.path.expanduser(DC_SSH_KEY), "-o", "BatchMode=yes"]
+    _SCP_AUTH = ["scp", "-i", os.path.expanduser(DC_SSH_KEY), "-o", "BatchMode=yes"]
+else:
+    _SSH_AUTH = ["sshpass", "-p", DC_PASSWORD, "ssh"]
+    _SCP_AUTH = ["sshpass", "-p", DC_PASSWORD, "scp"]
+
+SSH_ARGV = _SSH_AUTH + ["-o", "StrictHostKeyChecking=no",
+            "-o", "ControlMaster=auto", "-o", f"ControlPath={SSH_CONTROL_PATH}",
+            "-o", "ControlPersist=10m", "-o", "Compression=yes", f"{DC_USER}@{DC_HOST}"]
+SCP_ARGV = _SCP_AUTH + ["-o", "ControlMaster=auto",
+            "-o", f"ControlPath={SSH_CONTROL_PATH}", "-o", "ControlPersist=10m",
+            "-o", "Compression=yes"]
+
+@functools.lru_cache(maxsize=64)
+def encode_ps(script):
+    """PowerShell脚本的Base64编码（UTF-16LE），相同脚本只编码一次"""
+    return base64.b64encode(script.encode('utf-16-le')).decode('ascii')
+
+# 远程脚本哈希缓存：内容未变的脚本跳过重复上传（随远程清理一起失效）
+REMOTE_HASH_CACHE = os.path.join(OUTPUT_DIR, '.remote_script_hashes.json')
+_REMOTE_SCRIPT_HASHES = None
+
+def _file_sha256(path):
+    """计算本地文件的SHA-256"""
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def _remote_hashes():
+    """加载远程脚本哈希缓存（延迟读取一次）"""
+    global _REMOTE_SCRIPT_HASHES
+    if _REMOTE_SCRIPT_HASHES is None:
+        try:
+            with open(REMOTE_HASH_CACHE, 'r', encoding='utf-8') as f:
+                _REMOTE_SCRIPT_HASHES = json.load(f)
+        except (OSError, ValueError):
+            _REMOTE_SCRIPT_HASHES = {}
+    return _REMOTE_SCRIPT_HASHES
+
+def script_unchanged(ps_local):
+    """脚本内容自上次成功上传以来是否未变"""
+    return _remote_hashes().get(os.path.basename(ps_local)) == _file_sha256(ps_local)
+
+def remember_script_hash(ps_local):
+    """记录脚本上传成功后的内容哈希"""
+    hashes = _remote_hashes()
+    hashes[os.path.basename(ps_local)] = _file_sha256(ps_local)
+    try:
+        with open(REMOTE_HASH_CACHE, 'w', encoding='utf-8') as f:
+            json.dump(hashes, f)
+    except OSError:
+        pass
+
+def invalidate_script_hashes():
+    """清空脚本哈希缓存（远程脚本被删除后调用）"""
+    global _REMOTE_SCRIPT_HASHES
+    _REMOTE_SCRIPT_HASHES = {}
+    if os.path.exists(REMOTE_HASH_CACHE):
+        try:
+            os.remove(REMOTE_HASH_CACHE)
+        except OSError:
+            pass
+
+def run_on_dc(remote_cmd, max_retries=3, timeout=30):
+    """在域控制器上执行命令（所有调用复用同一个ControlMaster主连接）"""
+    return run_ssh_with_retry(SSH_ARGV + [remote_cmd], max_retries=max_retries, timeout=timeout)
+
+def copy_to_dc(local_path, remote_path, max_retries=3):
+    """上传文件到域控制器（复用ControlMaster连接）"""
+    return run_scp_with_retry(SCP_ARGV + [local_path, f"{DC_USER}@{DC_HOST}:{remote_path}"],
+                              max_retries=max_retries)
+
+def copy_many_to_dc(local_paths, remote_dir='~/', max_retries=3):
+    """一次scp上传多个文件到域控制器目录（保留原文件名，单进程单通道）"""
+    return run_scp_with_retry(SCP_ARGV + list(local_paths) + [f"{DC_USER}@{DC_HOST}:{remote_dir}"],
+                              max_retries=max_retries)
+
+def copy_from_dc(remote_path, local_path, max_retries=3):
+    """从域控制器下载文件（复用ControlMaster连接）"""
+    return run_scp_with_retry(SCP_ARGV + [f"{DC_USER}@{DC_HOST}:{remote_path}", local_path],
+                              max_retries=max_retries)
+
 # 拼音例外映射（飞书拼音 -> AD拼音）
 PINYIN_EXCEPTIONS = {}
 exceptions_str = os.getenv("PINYIN_EXCEPTIONS", "")
@@ -216,52 +345,6 @@ DRY_RUN = False
 # 自动确认标志
 AUTO_YES = False
 
-# Windows 编码（延迟初始化）
-WINDOWS_ENCODING = None
-
-def get_windows_encoding():
-    """获取 Windows 系统编码"""
-    global WINDOWS_ENCODING
-    
-    if WINDOWS_ENCODING:
-        return WINDOWS_ENCODING
-    
-    try:
-        # 获取 Windows 代码页
-        ssh_cmd = f"sshpass -p '{DC_PASSWORD}' ssh -o StrictHostKeyChecking=no -o ControlPath={SSH_CONTROL_PATH} {DC_USER}@{DC_HOST} 'powershell -Command \"[System.Text.Encoding]::Default.CodePage\"'"
-        result = run_ssh_with_retry(ssh_cmd, timeout=10)
-        
-        if result.returncode == 0:
-            code_page = result.stdout.decode('utf-8', errors='ignore').strip()
-            # 代码页映射
-            encoding_map = {
-                '936': 'gbk',      # 简体中文
-                '950': 'big5',     # 繁体中文
-                '65001': 'utf-8',  # UTF-8
-                '1252': 'cp1252'   # 西欧
-            }
-            WINDOWS_ENCODING = encoding_map.get(code_page, 'gbk')
-            print(f"检测到 Windows 编码: {WINDOWS_ENCODING} (代码页 {code_page})")
-        else:
-            # SSH 连接失败
-            if 'Permission denied' in result.stderr or 'Permission denied' in result.stdout:
-                print("\n✗ SSH 登录失败：密码错误或权限被拒绝")
-                print(f"  主机: {DC_HOST}")
-                print(f"  用户: {DC_USER}")
-                print("  请检查 .env 文件中的 DC_PASSWORD 配置")
-                sys.exit(1)
-            else:
-                WINDOWS_ENCODING = 'gbk'  # 默认使用 GBK
-                print(f"无法检测编码，使用默认: {WINDOWS_ENCODING}")
-    except Exception as e:
-        print(f"\n✗ 连接域控制器失败: {e}")
-        print(f"  主机: {DC_HOST}")
-        print(f"  用户: {DC_USER}")
-        print("  请检查网络连接和配置")
-        sys.exit(1)
-    
-    return WINDOWS_ENCODING
-
 def confirm(prompt, default=True):
     """交互式确认，默认为 y"""
     if DRY_RUN:
@@ -284,17 +367,13 @@ def confirm(prompt, default=True):
 def check_dc_permissions():
     """检查域控制器连接和权限"""
     print("\n检查域控制器连接和权限...")
-    
-    # 初始化用户主目录
-    init_dc_user_home()
-    
+
     try:
         # 直接测试 AD 模块和权限
-        ssh_cmd = f"sshpass -p '{DC_PASSWORD}' ssh -o StrictHostKeyChecking=no -o ControlPath={SSH_CONTROL_PATH} {DC_USER}@{DC_HOST} 'powershell -Command \"Import-Module ActiveDirectory; Get-ADDomain | Select-Object -ExpandProperty DNSRoot\"'"
-        result = run_ssh_with_retry(ssh_cmd, timeout=30)
+        result = run_on_dc('powershell -Command "Import-Module ActiveDirectory; Get-ADDomain | Select-Object -ExpandProperty DNSRoot"', timeout=30)
         
         if result.returncode == 0 and result.stdout.strip():
-            domain = result.stdout.decode('utf-8', errors='ignore').strip()
+            domain = result.stdout.strip()
             print(f"✓ 域控制器连接正常，当前域: {domain}")
             return True
         else:
@@ -308,190 +387,237 @@ def check_dc_permissions():
         print(f"✗ 检查失败: {e}")
         return False
 
-def get_ad_ou_count():
-    """从AD实时获取OU数量（排除DC_EXCLUDE_OU和DC_BASE_OU本身）"""
+def run_startup_probes():
+    """并行执行相互独立的启动探测：远程用户主目录与AD权限检查
+
+    两个探测都只阻塞在SSH等待上，放进线程池并发可以把串行的
+    多次网络往返压缩成最慢的一次。返回权限检查结果。
+    ControlMaster=auto 会让最先到达的调用自动建立主连接。
+    """
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        home_future = pool.submit(init_dc_user_home)
+        perm_future = pool.submit(check_dc_permissions)
+        home_future.result()
+        return perm_future.result()
+
+# AD数量缓存（本次运行内OU/用户数量只查询一次）
+_AD_COUNTS = {}
+
+def _ou_count_pipeline():
+    """构建统计OU数量的PowerShell管道（排除DC_EXCLUDE_OU和DC_BASE_OU本身）"""
     if DC_BASE_OU:
         base_filter = f"Get-ADOrganizationalUnit -Filter * -SearchBase '{DC_BASE_OU}'"
     else:
         base_filter = "Get-ADOrganizationalUnit -Filter *"
-    
-    # 添加排除逻辑
+
     if DC_EXCLUDE_OU:
-        ps_script = f"{base_filter} | Where-Object {{$_.DistinguishedName -ne '{DC_BASE_OU}' -and $_.DistinguishedName -ne '{DC_EXCLUDE_OU}' -and $_.DistinguishedName -notlike '*,{DC_EXCLUDE_OU}'}} | Measure-Object | Select-Object -ExpandProperty Count"
+        return f"{base_filter} | Where-Object {{$_.DistinguishedName -ne '{DC_BASE_OU}' -and $_.DistinguishedName -ne '{DC_EXCLUDE_OU}' -and $_.DistinguishedName -notlike '*,{DC_EXCLUDE_OU}'}}"
     elif DC_BASE_OU:
-        ps_script = f"{base_filter} | Where-Object {{$_.DistinguishedName -ne '{DC_BASE_OU}'}} | Measure-Object | Select-Object -ExpandProperty Count"
-    else:
-        ps_script = f"{base_filter} | Measure-Object | Select-Object -ExpandProperty Count"
-    
-    # Base64编码PowerShell命令（UTF-16LE）
-    import base64
-    encoded = base64.b64encode(ps_script.encode('utf-16-le')).decode('ascii')
-    
-    ssh_cmd = f"sshpass -p '{DC_PASSWORD}' ssh -o StrictHostKeyChecking=no -o ControlPath={SSH_CONTROL_PATH} {DC_USER}@{DC_HOST} 'powershell -EncodedCommand {encoded}'"
-    result = run_ssh_with_retry(ssh_cmd, timeout=30)
-    
-    if result.returncode != 0:
-        stderr = result.stderr.decode('utf-8', errors='replace') if result.stderr else ''
-        raise Exception(f"获取AD OU数量失败: {stderr}")
-    
-    try:
-        count = int(result.stdout.decode('utf-8').strip())
-        return count
-    except ValueError:
-        stdout = result.stdout.decode('utf-8', errors='replace') if result.stdout else ''
-        raise Exception(f"解析AD OU数量失败: {stdout}")
+        return f"{base_filter} | Where-Object {{$_.DistinguishedName -ne '{DC_BASE_OU}'}}"
+    return base_filter
 
-def get_ad_user_count():
-    """从AD实时获取用户数量"""
+def _user_count_pipeline():
+    """构建统计用户数量的PowerShell管道"""
     if DC_BASE_OU:
         filter_cmd = f"Get-ADUser -Filter * -SearchBase '{DC_BASE_OU}'"
     else:
         filter_cmd = "Get-ADUser -Filter *"
-    
+
     if DC_EXCLUDE_OU:
         # 排除指定 OU，但离职员工 OU 总是包含
         if DC_RESIGNED_OU:
-            ps_script = f"{filter_cmd} | Where-Object {{($_.DistinguishedName -notlike '*{DC_EXCLUDE_OU}') -or ($_.DistinguishedName -like '*{DC_RESIGNED_OU}*')}} | Measure-Object | Select-Object -ExpandProperty Count"
-        else:
-            ps_script = f"{filter_cmd} | Where-Object {{$_.DistinguishedName -notlike '*{DC_EXCLUDE_OU}'}} | Measure-Object | Select-Object -ExpandProperty Count"
-    else:
-        ps_script = f"{filter_cmd} | Measure-Object | Select-Object -ExpandProperty Count"
-    
-    # Base64编码PowerShell命令（UTF-16LE）
-    import base64
-    encoded = base64.b64encode(ps_script.encode('utf-16-le')).decode('ascii')
-    
-    ssh_cmd = f"sshpass -p '{DC_PASSWORD}' ssh -o StrictHostKeyChecking=no -o ControlPath={SSH_CONTROL_PATH} {DC_USER}@{DC_HOST} 'powershell -EncodedCommand {encoded}'"
-    result = run_ssh_with_retry(ssh_cmd, timeout=30)
-    
+            return f"{filter_cmd} | Where-Object {{($_.DistinguishedName -notlike '*{DC_EXCLUDE_OU}') -or ($_.DistinguishedName -like '*{DC_RESIGNED_OU}*')}}"
+        return f"{filter_cmd} | Where-Object {{$_.DistinguishedName -notlike '*{DC_EXCLUDE_OU}'}}"
+    return filter_cmd
+
+def get_ad_counts(refresh=False):
+    """一次SSH往返同时获取AD的OU数量和用户数量，结果缓存供本次运行复用"""
+    if _AD_COUNTS and not refresh:
+        return _AD_COUNTS['ou'], _AD_COUNTS['user']
+
+    # 两个统计合并进同一个PowerShell会话，省掉一次SSH往返
+    ps_script = (
+        f"$o = @({_ou_count_pipeline()}).Count\n"
+        f"$u = @({_user_count_pipeline()}).Count\n"
+        'Write-Output "OU=$o"\n'
+        'Write-Output "USR=$u"'
+    )
+
+    # Base64编码PowerShell命令（UTF-16LE，带缓存）
+    result = run_on_dc(f'powershell -EncodedCommand {encode_ps(ps_script)}', timeout=30)
+
     if result.returncode != 0:
-        stderr = result.stderr.decode('utf-8', errors='replace') if result.stderr else ''
-        raise Exception(f"获取AD用户数量失败: {stderr}")
-    
+        raise Exception(f"获取AD数量统计失败: {result.stderr or ''}")
+
+    stdout = result.stdout or ''
+    counts = {}
+    for line in stdout.splitlines():
+        line = line.strip()
+        if line.startswith('OU='):
+            counts['ou'] = int(line[3:])
+        elif line.startswith('USR='):
+            counts['user'] = int(line[4:])
+
+    if 'ou' not in counts or 'user' not in counts:
+        raise Exception(f"解析AD数量统计失败: {stdout}")
+
+    _AD_COUNTS.update(counts)
+    return _AD_COUNTS['ou'], _AD_COUNTS['user']
+
+def get_ad_ou_count():
+    """从AD获取OU数量（复用 get_ad_counts 的缓存结果）"""
+    return get_ad_counts()[0]
+
+def get_ad_user_count():
+    """从AD获取用户数量（复用 get_ad_counts 的缓存结果）"""
+    return get_ad_counts()[1]
+
+# AD导出状态缓存（export_all.ps1 只执行一次，OU和用户共享结果）
+_AD_EXPORT_STATUS = None
+
+def export_ad_snapshot():
+    """上传并执行 export_all.ps1：单次SSH会话内导出OU和用户CSV并带回数量统计
+
+    返回 {'ous': 下载返回码, 'users': 下载返回码}，重复调用直接返回缓存结果。
+    """
+    global _AD_EXPORT_STATUS
+
+    if _AD_EXPORT_STATUS is not None:
+        return _AD_EXPORT_STATUS
+
+    ps_export = get_ps_path('export_all.ps1')
+    if not os.path.exists(ps_export):
+        print(f"❌ 错误: 找不到脚本 {ps_export}")
+        print("无法导出AD数据，同步失败！")
+        sys.exit(1)
+
     try:
-        count = int(result.stdout.decode('utf-8').strip())
-        return count
-    except ValueError:
-        stdout = result.stdout.decode('utf-8', errors='replace') if result.stdout else ''
-        raise Exception(f"解析AD用户数量失败: {stdout}")
+        if not script_unchanged(ps_export):
+            result = copy_to_dc(ps_export, '~/export_all.ps1')
+            if result.returncode == 0:
+                remember_script_hash(ps_export)
+        result = run_on_dc(f'powershell -ExecutionPolicy Bypass -File {DC_USER_HOME}/export_all.ps1', timeout=120)
+    except Exception as e:
+        print(f"❌ 连接域控制器失败: {e}")
+        print("无法导出AD数据，同步失败！")
+        sys.exit(1)
+
+    # 解析随导出一起打印的数量，填充 get_ad_counts 的缓存（省掉单独的统计查询）
+    stdout = result.stdout or ''
+    counts = {}
+    for line in stdout.splitlines():
+        line = line.strip()
+        try:
+            if line.startswith('OU_COUNT='):
+                counts['ou'] = int(line[len('OU_COUNT='):])
+            elif line.startswith('USER_COUNT='):
+                counts['user'] = int(line[len('USER_COUNT='):])
+        except ValueError:
+            pass
+    if 'ou' in counts and 'user' in counts:
+        _AD_COUNTS.update(counts)
+
+    # 优先下载服务端打包的压缩包（单次传输，压缩后体积约为CSV的十分之一）
+    ou_rc = user_rc = 1
+    zip_local = get_output_path('ad_dump.zip')
+    ous_local = get_output_path('ad_existing_ous.csv')
+    users_local = get_output_path('ad_existing_users.csv')
+    zip_result = copy_from_dc('~/ad_dump.zip', zip_local)
+    if zip_result.returncode == 0:
+        try:
+            with zipfile.ZipFile(zip_local) as zf:
+                names = zf.namelist()
+                if 'ExistingOUs.csv' in names:
+                    with zf.open('ExistingOUs.csv') as src, open(ous_local, 'wb') as dst:
+                        dst.write(src.read())
+                    ou_rc = 0
+                if 'ExportedUsers.csv' in names:
+                    with zf.open('ExportedUsers.csv') as src, open(users_local, 'wb') as dst:
+                        dst.write(src.read())
+                    user_rc = 0
+        except zipfile.BadZipFile:
+            pass
+        finally:
+            if os.path.exists(zip_local):
+                os.remove(zip_local)
+
+    # 压缩包缺失或不完整时退回逐个下载（各自的失败由调用方结合数量验证兜底）
+    if ou_rc != 0:
+        ou_rc = copy_from_dc('~/ExistingOUs.csv', ous_local).returncode
+    if user_rc != 0:
+        user_rc = copy_from_dc('~/ExportedUsers.csv', users_local).returncode
+
+    _AD_EXPORT_STATUS = {'ous': ou_rc, 'users': user_rc}
+    return _AD_EXPORT_STATUS
 
 def get_existing_ad_departments():
     """从域控制器获取现有部门OU列表，返回完整路径集合"""
     print("正在获取 AD 域现有部门 OU...")
-    
-    # 根据配置决定是否限制 SearchBase
-    if DC_BASE_OU:
-        ps_script = f"""
-Import-Module ActiveDirectory
-$baseOU = "{DC_BASE_OU}"
-Get-ADOrganizationalUnit -Filter * -SearchBase $baseOU | 
-    Select-Object Name, DistinguishedName | 
-    Export-Csv -Path "~/ExistingOUs.csv" -NoTypeInformation -Encoding UTF8
-"""
-        search_info = f"在 {DC_BASE_OU} 下"
-    else:
-        ps_script = """
-Import-Module ActiveDirectory
-Get-ADOrganizationalUnit -Filter * | 
-    Select-Object Name, DistinguishedName | 
-    Export-Csv -Path "~/ExistingOUs.csv" -NoTypeInformation -Encoding UTF8
-"""
-        search_info = "全域"
-    
-    # 写入临时脚本，使用 UTF-8 BOM 编码
-    with open(get_output_path('temp_get_ous.ps1'), 'w', encoding='utf-8-sig') as f:
-        f.write(ps_script)
-    
-    try:
-        # 上传并执行
-        scp_cmd = f"sshpass -p '{DC_PASSWORD}' scp -o ControlPath={SSH_CONTROL_PATH} {get_output_path('temp_get_ous.ps1')} {DC_USER}@{DC_HOST}:~/GetOUs.ps1"
-        run_scp_with_retry(scp_cmd)
-        
-        ssh_cmd = f"sshpass -p '{DC_PASSWORD}' ssh -o StrictHostKeyChecking=no -o ControlPath={SSH_CONTROL_PATH} {DC_USER}@{DC_HOST} 'powershell -ExecutionPolicy Bypass -File {DC_USER_HOME}/GetOUs.ps1'"
-        result = run_ssh_with_retry(ssh_cmd)
-        
-        if result.returncode != 0:
-            print(f"执行脚本失败，尝试获取全部 OU...")
-            # 如果失败，尝试获取所有 OU
-            ps_script_all = """
-Import-Module ActiveDirectory
-Get-ADOrganizationalUnit -Filter * | 
-    Select-Object Name, DistinguishedName | 
-    Export-Csv -Path "~/ExistingOUs.csv" -NoTypeInformation -Encoding UTF8
-"""
-            with open(get_output_path('temp_get_ous.ps1'), 'w', encoding='utf-8-sig') as f:
-                f.write(ps_script_all)
-            
-            scp_cmd = f"sshpass -p '{DC_PASSWORD}' scp -o ControlPath={SSH_CONTROL_PATH} {get_output_path('temp_get_ous.ps1')} {DC_USER}@{DC_HOST}:~/GetOUs.ps1"
-            run_scp_with_retry(scp_cmd)
-            
-            ssh_cmd = f"sshpass -p '{DC_PASSWORD}' ssh -o StrictHostKeyChecking=no -o ControlPath={SSH_CONTROL_PATH} {DC_USER}@{DC_HOST} 'powershell -ExecutionPolicy Bypass -File {DC_USER_HOME}/GetOUs.ps1'"
-            run_ssh_with_retry(ssh_cmd)
-            search_info = "全域(降级)"
-        
-        # 下载结果
-        scp_cmd = f"sshpass -p '{DC_PASSWORD}' scp -o ControlPath={SSH_CONTROL_PATH} {DC_USER}@{DC_HOST}:~/ExistingOUs.csv {get_output_path('ad_existing_ous.csv')}"
-        result = run_scp_with_retry(scp_cmd)
-        
-        if result.returncode != 0:
-            # 文件下载失败，可能是AD上没有OU，先验证数量
-            print("⚠ 下载AD OU文件失败，验证AD上是否真的没有OU...")
-            try:
-                actual_count = get_ad_ou_count()
-                if actual_count == 0:
-                    print("✓ AD上确实没有OU，继续执行")
-                    return {}
-                else:
-                    print(f"❌ AD上有 {actual_count} 个OU，但文件下载失败")
-                    print("数据获取失败，同步失败！")
-                    sys.exit(1)
-            except Exception as e:
-                print(f"❌ 无法验证AD OU数量: {e}")
-                print("无法确认数据状态，同步失败！")
+    search_info = f"在 {DC_BASE_OU} 下" if DC_BASE_OU else "全域"
+
+    status = export_ad_snapshot()
+
+    if status['ous'] != 0:
+        # 文件下载失败，可能是AD上没有OU，先验证数量
+        print("⚠ 下载AD OU文件失败，验证AD上是否真的没有OU...")
+        try:
+            actual_count = get_ad_ou_count()
+            if actual_count == 0:
+                print("✓ AD上确实没有OU，继续执行")
+                return {}
+            else:
+                print(f"❌ AD上有 {actual_count} 个OU，但文件下载失败")
+                print("数据获取失败，同步失败！")
                 sys.exit(1)
-    finally:
-        # 清理临时文件
-        if os.path.exists(get_output_path('temp_get_ous.ps1')):
-            os.remove(get_output_path('temp_get_ous.ps1'))
-    
+        except Exception as e:
+            print(f"❌ 无法验证AD OU数量: {e}")
+            print("无法确认数据状态，同步失败！")
+            sys.exit(1)
+
+
     # 读取现有 OU，返回 {名称: DN} 的字典
     existing_ous = {}
     base_ou_dn = DC_BASE_OU if DC_BASE_OU else ""
-    
+    # 排除OU的后缀只拼一次（导出脚本已在服务端过滤，这里仅兜底）
+    excl_suffix = ',' + DC_EXCLUDE_OU if DC_EXCLUDE_OU else None
+
     try:
-        # PowerShell 使用 UTF8 导出，直接使用 utf-8-sig
-        with open(get_output_path('ad_existing_ous.csv'), 'r', encoding='utf-8-sig') as f:
-            reader = csv.DictReader(f)
+        # 编码按文件前缀探测一次（导出脚本固定UTF-8，BOM存在时走utf-8-sig）
+        # 热路径用 csv.reader + 列索引，避免 DictReader 逐行建字典
+        ous_csv = get_output_path('ad_existing_ous.csv')
+        with open(ous_csv, 'r', encoding=detect_csv_encoding(ous_csv)) as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            name_i = header.index('Name')
+            dn_i = header.index('DistinguishedName')
             for row in reader:
-                name = row['Name']
-                dn = row['DistinguishedName']
+                name = row[name_i]
+                dn = row[dn_i]
                 # 排除基础 OU 本身
                 if dn == base_ou_dn:
                     continue
                 # 排除指定的 OU 及其所有子 OU
-                if DC_EXCLUDE_OU and (dn == DC_EXCLUDE_OU or dn.endswith(',' + DC_EXCLUDE_OU)):
+                if excl_suffix and (dn == DC_EXCLUDE_OU or dn.endswith(excl_suffix)):
                     continue
                 # 使用 DN 作为唯一标识
                 existing_ous[dn] = name
         print(f"✓ 发现 {len(existing_ous)} 个现有部门 OU ({search_info})")
         
-        # 验证数据完整性：从AD实时获取数量并对比
+        # 验证数据完整性：对比导出脚本随行打印的数量（无额外SSH往返）
         print("正在验证OU数据完整性...")
-        try:
-            actual_count = get_ad_ou_count()
+        actual_count = _AD_COUNTS.get('ou')
+        if actual_count is None:
+            print("⚠ 导出脚本未返回OU数量，跳过本地验证")
+        else:
             csv_count = len(existing_ous)
             print(f"  AD实际OU数: {actual_count}")
             print(f"  CSV文件OU数: {csv_count}")
-            
+
             if actual_count != csv_count:
                 print(f"❌ OU数量不匹配！实际: {actual_count}, CSV: {csv_count}")
                 print("数据可能不完整，同步失败！")
                 sys.exit(1)
             print("✓ OU数据验证通过")
-        except Exception as e:
-            print(f"❌ 验证OU数据失败: {e}")
-            print("无法确认数据完整性，同步失败！")
-            sys.exit(1)
     except Exception as e:
         print(f"❌ 读取现有 OU 列表失败: {e}")
         sys.exit(1)
@@ -504,71 +630,63 @@ def get_existing_ad_users():
     2. {SamAccountName: {SamAccountName, DisplayName, EmailAddress}} - 没有 Union ID 的用户
     """
     print("正在获取..." if not DRY_RUN else "")
-    
-    # 使用本地脚本副本
-    ps_export = get_ps_path('export_users.ps1')
-    if not os.path.exists(ps_export):
-        print(f"❌ 错误: 找不到脚本 {ps_export}")
-        print("无法获取AD现有用户，同步失败！")
-        sys.exit(1)
-    
-    try:
-        # 上传脚本
-        scp_cmd = f"sshpass -p '{DC_PASSWORD}' scp -o ControlPath={SSH_CONTROL_PATH} {ps_export} {DC_USER}@{DC_HOST}:~/ExportUsers.ps1"
-        run_scp_with_retry(scp_cmd)
-        
-        # 执行导出
-        ssh_cmd = f"sshpass -p '{DC_PASSWORD}' ssh -o StrictHostKeyChecking=no -o ControlPath={SSH_CONTROL_PATH} {DC_USER}@{DC_HOST} 'powershell -ExecutionPolicy Bypass -File {DC_USER_HOME}/ExportUsers.ps1'"
-        run_ssh_with_retry(ssh_cmd)
-        
-        # 下载导出的用户列表
-        scp_cmd = f"sshpass -p '{DC_PASSWORD}' scp -o ControlPath={SSH_CONTROL_PATH} {DC_USER}@{DC_HOST}:~/ExportedUsers.csv {get_output_path('ad_existing_users.csv')}"
-        result = run_scp_with_retry(scp_cmd)
-        
-        if result.returncode != 0:
-            # 文件下载失败，可能是AD上没有用户，先验证数量
-            print("⚠ 下载AD用户文件失败，验证AD上是否真的没有用户...")
-            try:
-                actual_count = get_ad_user_count()
-                if actual_count == 0:
-                    print("✓ AD上确实没有用户，继续执行")
-                    return {}, {}
-                else:
-                    print(f"❌ AD上有 {actual_count} 个用户，但文件下载失败")
-                    print("数据获取失败，同步失败！")
-                    sys.exit(1)
-            except Exception as e:
-                print(f"❌ 无法验证AD用户数量: {e}")
-                print("无法确认数据状态，同步失败！")
+
+    status = export_ad_snapshot()
+
+    if status['users'] != 0:
+        # 文件下载失败，可能是AD上没有用户，先验证数量
+        print("⚠ 下载AD用户文件失败，验证AD上是否真的没有用户...")
+        try:
+            actual_count = get_ad_user_count()
+            if actual_count == 0:
+                print("✓ AD上确实没有用户，继续执行")
+                return {}, {}
+            else:
+                print(f"❌ AD上有 {actual_count} 个用户，但文件下载失败")
+                print("数据获取失败，同步失败！")
                 sys.exit(1)
-    except Exception as e:
-        print(f"❌ 连接域控制器失败: {e}")
-        print("无法获取AD现有用户，同步失败！")
-        sys.exit(1)
-    
+        except Exception as e:
+            print(f"❌ 无法验证AD用户数量: {e}")
+            print("无法确认数据状态，同步失败！")
+            sys.exit(1)
+
+
     # 读取现有用户的信息，使用 EmployeeNumber (Union ID) 作为键，没有则用 SamAccountName
     existing_users = {}
     users_without_union_id = {}  # 没有 Union ID 的用户，用 SamAccountName 作为键
     disabled_count = 0  # 禁用用户计数
     
+    # 编码按文件前缀探测一次（不再多编码重试整个文件）
+    users_csv = get_output_path('ad_existing_users.csv')
+    users_encoding = detect_csv_encoding(users_csv)
+
     try:
-        # PowerShell 使用 UTF8 导出，直接使用 utf-8-sig
-        with open(get_output_path('ad_existing_users.csv'), 'r', encoding='utf-8-sig') as f:
-            reader = csv.DictReader(f)
+        # 热路径用 csv.reader + 列索引，避免 DictReader 逐行建字典
+        with open(users_csv, 'r', encoding=users_encoding) as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            idx = {name: i for i, name in enumerate(header)}
+            sam_i = idx['SamAccountName']
+            emp_i = idx.get('EmployeeNumber')
+            enabled_i = idx.get('Enabled')
+            dn_i = idx.get('DistinguishedName')
+            display_i = idx.get('DisplayName')
+            email_i = idx.get('EmailAddress')
+            empid_i = idx.get('EmployeeID')
             for row in reader:
-                sam = row['SamAccountName']
-                employee_number = row.get('EmployeeNumber', '').strip()
-                enabled = row.get('Enabled', 'True').strip().lower() == 'true'
-                dn = row.get('DistinguishedName', '').strip()
-                
+                sam = row[sam_i]
+                employee_number = row[emp_i].strip() if emp_i is not None else ''
+                enabled = (row[enabled_i].strip().lower() == 'true') if enabled_i is not None else True
+                dn = row[dn_i].strip() if dn_i is not None else ''
+
                 if not enabled:
                     disabled_count += 1
-                
+
                 user_info = {
                     'SamAccountName': sam,
-                    'DisplayName': row.get('DisplayName', ''),
-                    'EmailAddress': row.get('EmailAddress', ''),
-                    'EmployeeID': row.get('EmployeeID', ''),
+                    'DisplayName': row[display_i] if display_i is not None else '',
+                    'EmailAddress': row[email_i] if email_i is not None else '',
+                    'EmployeeID': row[empid_i] if empid_i is not None else '',
                     'Enabled': enabled,
                     'DistinguishedName': dn
                 }
@@ -583,56 +701,34 @@ def get_existing_ad_users():
         total_users = len(existing_users) + len(users_without_union_id)
         print(f"✓ 发现 {total_users} 个现有用户（{len(existing_users)} 个有 Union ID，{len(users_without_union_id)} 个无 Union ID，{disabled_count} 个禁用）")
     except Exception as e:
-        print(f"读取现有用户列表失败: {e}")
-        # 如果失败，尝试其他编码
-        for enc in ['utf-8-sig', 'gb2312', 'utf-16']:
-            try:
-                with open(get_output_path('ad_existing_users.csv'), 'r', encoding=enc) as f:
-                    reader = csv.DictReader(f)
-                    for row in reader:
-                        sam = row['SamAccountName']
-                        employee_number = row.get('EmployeeNumber', '').strip()
-                        user_info = {
-                            'SamAccountName': sam,
-                            'DisplayName': row.get('DisplayName', ''),
-                            'EmailAddress': row.get('EmailAddress', ''),
-                            'EmployeeID': row.get('EmployeeID', '')
-                        }
-                        
-                        if employee_number:
-                            existing_users[employee_number] = user_info
-                        else:
-                            users_without_union_id[sam] = user_info
-                
-                total_users = len(existing_users) + len(users_without_union_id)
-                print(f"✓ 使用 {enc} 编码读取成功，发现 {total_users} 个用户（{len(existing_users)} 个有 Union ID，{len(users_without_union_id)} 个无 Union ID）")
-                break
-            except:
-                continue
-        else:
-            print(f"❌ 所有编码尝试均失败")
-            sys.exit(1)
+        print(f"❌ 读取现有用户列表失败: {e}")
+        print("无法获取AD现有用户，同步失败！")
+        sys.exit(1)
     
-    # 验证数据完整性：从AD实时获取数量并对比
+    # 验证数据完整性：对比导出脚本随行打印的数量（无额外SSH往返）
     print("正在验证用户数据完整性...")
-    try:
-        actual_count = get_ad_user_count()
+    actual_count = _AD_COUNTS.get('user')
+    if actual_count is None:
+        print("⚠ 导出脚本未返回用户数量，跳过本地验证")
+    else:
         csv_count = len(existing_users) + len(users_without_union_id)
         print(f"  AD实际用户数: {actual_count}")
         print(f"  CSV文件用户数: {csv_count}")
-        
+
         if actual_count != csv_count:
             print(f"❌ 用户数量不匹配！实际: {actual_count}, CSV: {csv_count}")
             print("数据可能不完整，同步失败！")
             sys.exit(1)
         print("✓ 用户数据验证通过")
-    except Exception as e:
-        print(f"❌ 验证用户数据失败: {e}")
-        print("无法确认数据完整性，同步失败！")
-        sys.exit(1)
-    
+
     return existing_users, users_without_union_id
 
+# 同步计划行结构（字段顺序即CSV列顺序，namedtuple可直接交给csv.writer）
+NewUser = namedtuple('NewUser', ['DisplayName', 'SamAccountName', 'EmailAddress',
+                                 'EmployeeID', 'EmployeeNumber', 'info', 'DepartmentName'])
+UpdateUser = namedtuple('UpdateUser', ['SamAccountName', 'DisplayName', 'EmailAddress',
+                                       'EmployeeID', 'EmployeeNumber', 'info', 'DepartmentName'])
+
 def split_users_for_sync(feishu_csv, existing_users, users_without_union_id):
     """将飞书用户分为新建和更新两类，处理拼音重名"""
     new_users = []
@@ -645,136 +741,163 @@ def split_users_for_sync(feishu_csv, existing_users, users_without_union_id):
     dept_csv = get_output_path('feishu_departments.csv')
     
     if os.path.exists(dept_csv):
+        # 边读边建ID索引，不再物化完整的部门行列表
         with open(dept_csv, 'r', encoding='utf-8-sig') as f:
-            reader = csv.DictReader(f)
-            dept_list = list(reader)
-        
-        # 递归构建部门路径
-        def build_dept_path(dept_id, dept_list):
-            if dept_id == "0":
-                return ""
-            
-            dept = next((d for d in dept_list if d['dept_id'] == dept_id), None)
-            if not dept:
-                return ""
-            
-            parent_id = dept['parent_dept_id']
-            dept_name = dept['dept_name']
-            
-            if parent_id == "0":
-                return dept_name
-            else:
-                parent_path = build_dept_path(parent_id, dept_list)
-                return f"{parent_path}\\{dept_name}" if parent_path else dept_name
-        
-        # 为所有部门构建路径
-        for dept in dept_list:
-            dept_id = dept['dept_id']
-            dept_path_map[dept_id] = build_dept_path(dept_id, dept_list)
-    
-    # 读取所有飞书用户
-    feishu_users_list = []
-    with open(feishu_csv, 'r', encoding='utf-8-sig') as f:
-        reader = csv.DictReader(f)
-        feishu_users_list = list(reader)
-    
-    # 检测拼音重名
+            reader = csv.reader(f)
+            header = next(reader)
+            id_i = header.index('dept_id')
+            parent_i = header.index('parent_dept_id')
+            name_i = header.index('dept_name')
+            dept_by_id = {row[id_i]: (row[parent_i], row[name_i]) for row in reader}
+
+        # 自顶向下单次遍历构建路径：父先于子，每个部门恰好拼接一次
+        children = {}
+        for did, (parent_id, _) in dept_by_id.items():
+            children.setdefault(parent_id, []).append(did)
+
+        stack = [("", cid) for cid in children.get("0", [])]
+        while stack:
+            prefix, did = stack.pop()
+            dept_name = dept_by_id[did][1]
+            path = f"{prefix}\\{dept_name}" if prefix else dept_name
+            dept_path_map[did] = path
+            for cid in children.get(did, []):
+                stack.append((path, cid))
+
+        # 父链断裂（父ID不在CSV中）的部门按根级处理，与旧行为一致
+        for did, (parent_id, dept_name) in dept_by_id.items():
+            if did not in dept_path_map and parent_id != "0" and parent_id not in dept_by_id:
+                stack = [("", did)]
+                while stack:
+                    prefix, cur = stack.pop()
+                    name = dept_by_id[cur][1]
+                    path = f"{prefix}\\{name}" if prefix else name
+                    dept_path_map[cur] = path
+                    for cid in children.get(cur, []):
+                        if cid not in dept_path_map:
+                            stack.append((path, cid))
+    
+    # 第一遍只收集拼音->工号映射用于重名检测，不物化完整用户行
     pinyin_count = {}
-    for user in feishu_users_list:
-        pinyin = user['pinyin']
-        if pinyin not in pinyin_count:
-            pinyin_count[pinyin] = []
-        pinyin_count[pinyin].append(user)
-    
-    # 为每个用户确定 SamAccountName
-    for row in feishu_users_list:
-        pinyin = row['pinyin']
-        user_id = row['user_id']  # 用户ID
-        union_id = row.get('union_id', '')  # Union ID
-        user_uuid = row.get('uuid', '')  # UUID
-        employee_no = row['employee_no']  # 工号
-        display_name = row['name']
-        email = row['enterprise_email']
-        dept_id = row.get('dept_id', '')
+    with open(feishu_csv, 'r', encoding='utf-8-sig') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        pinyin_i = header.index('pinyin')
+        empno_i = header.index('employee_no')
+        for user in reader:
+            pinyin = user[pinyin_i]
+            if pinyin not in pinyin_count:
+                pinyin_count[pinyin] = []
+            pinyin_count[pinyin].append(user[empno_i])
+
+    # 重名组按工号排序一次，记录每个工号的序号（主循环里O(1)查找）
+    pinyin_order = {}
+    for pinyin, employee_nos in pinyin_count.items():
+        if len(employee_nos) > 1:
+            pinyin_order[pinyin] = {no: i for i, no in enumerate(sorted(employee_nos))}
+    # 第二遍只查重名序号表，原始的拼音->工号映射可以立即释放
+    del pinyin_count
+
+    # 第二遍流式处理每个用户，确定 SamAccountName
+    with open(feishu_csv, 'r', encoding='utf-8-sig') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        idx = {name: i for i, name in enumerate(header)}
+        pinyin_i = idx['pinyin']
+        userid_i = idx['user_id']
+        union_i = idx.get('union_id')
+        uuid_i = idx.get('uuid')
+        empno_i = idx['employee_no']
+        name_i = idx['name']
+        email_i = idx['enterprise_email']
+        dept_i = idx.get('dept_id')
+        for row in reader:
+            pinyin = row[pinyin_i]
+            user_id = row[userid_i]  # 用户ID
+            union_id = row[union_i] if union_i is not None else ''  # Union ID
+            user_uuid = row[uuid_i] if uuid_i is not None else ''  # UUID
+            employee_no = row[empno_i]  # 工号
+            display_name = row[name_i]
+            email = row[email_i]
+            dept_id = row[dept_i] if dept_i is not None else ''
         
-        # 从部门ID获取完整部门路径
-        dept_path = dept_path_map.get(dept_id, '') if dept_id else ''
+            # 从部门ID获取完整部门路径
+            dept_path = dept_path_map.get(dept_id, '') if dept_id else ''
         
-        # 优先检查拼音例外映射
-        if pinyin in PINYIN_EXCEPTIONS:
-            sam_account = PINYIN_EXCEPTIONS[pinyin]
-        # 确定 SamAccountName：拼音重名时，按工号排序
-        elif len(pinyin_count[pinyin]) > 1:
-            # 拼音重名，按工号排序，工号最小的用拼音，其他加序号
-            sorted_users = sorted(pinyin_count[pinyin], key=lambda x: x['employee_no'])
-            if employee_no == sorted_users[0]['employee_no']:
-                sam_account = pinyin  # 工号最小，用拼音
-            else:
-                # 工号较大，在名字后、姓氏前加序号（从1开始）
-                # 例如：jiayi.wang -> jiayi1.wang
-                index = next(i for i, u in enumerate(sorted_users) if u['employee_no'] == employee_no)
-                parts = pinyin.split('.')
-                if len(parts) == 2:
-                    sam_account = f"{parts[0]}{index}.{parts[1]}"
+            # 优先检查拼音例外映射
+            if pinyin in PINYIN_EXCEPTIONS:
+                sam_account = PINYIN_EXCEPTIONS[pinyin]
+            # 确定 SamAccountName：拼音重名时，按工号排序
+            elif pinyin in pinyin_order:
+                # 拼音重名，按工号排序，工号最小的用拼音，其他加序号
+                index = pinyin_order[pinyin][employee_no]
+                if index == 0:
+                    sam_account = pinyin  # 工号最小，用拼音
                 else:
-                    sam_account = f"{pinyin}{index}"
-        else:
-            sam_account = pinyin  # 拼音不重名，用拼音
+                    # 工号较大，在名字后、姓氏前加序号（从1开始）
+                    # 例如：jiayi.wang -> jiayi1.wang
+                    parts = pinyin.split('.')
+                    if len(parts) == 2:
+                        sam_account = f"{parts[0]}{index}.{parts[1]}"
+                    else:
+                        sam_account = f"{pinyin}{index}"
+            else:
+                sam_account = pinyin  # 拼音不重名，用拼音
         
-        # 匹配逻辑：优先通过 Union ID，其次通过 SamAccountName
-        matched_sam = None
+            # 匹配逻辑：优先通过 Union ID，其次通过 SamAccountName
+            matched_sam = None
         
-        # 1. 通过 Union ID 查找现有用户
-        if union_id and union_id in existing_users:
-            ad_info = existing_users[union_id]
-            matched_sam = ad_info['SamAccountName']
-            matched_ad_users.add(union_id)  # 记录匹配的 AD 用户（使用 Union ID）
-        # 2. 如果没有 Union ID 匹配，尝试通过 SamAccountName 匹配（针对旧用户）
-        elif sam_account in users_without_union_id:
-            ad_info = users_without_union_id[sam_account]
-            matched_sam = sam_account
-            matched_ad_users_no_uid.add(sam_account)  # 记录匹配的旧用户
+            # 1. 通过 Union ID 查找现有用户
+            if union_id and union_id in existing_users:
+                ad_info = existing_users[union_id]
+                matched_sam = ad_info['SamAccountName']
+                matched_ad_users.add(union_id)  # 记录匹配的 AD 用户（使用 Union ID）
+            # 2. 如果没有 Union ID 匹配，尝试通过 SamAccountName 匹配（针对旧用户）
+            elif sam_account in users_without_union_id:
+                ad_info = users_without_union_id[sam_account]
+                matched_sam = sam_account
+                matched_ad_users_no_uid.add(sam_account)  # 记录匹配的旧用户
         
-        if matched_sam:
-            # 用户已存在，更新用户（EmployeeID 使用工号，EmployeeNumber 使用 Union ID）
-            update_users.append({
-                'SamAccountName': matched_sam,
-                'DisplayName': display_name,
-                'EmailAddress': email,
-                'EmployeeID': employee_no,
-                'EmployeeNumber': union_id,
-                'info': user_uuid,
-                'DepartmentName': dept_path
-            })
-        else:
-            # 新建用户（EmployeeID 使用工号，EmployeeNumber 使用 Union ID）
-            new_users.append({
-                'DisplayName': display_name,
-                'SamAccountName': sam_account,
-                'EmailAddress': email,
-                'EmployeeID': employee_no,
-                'EmployeeNumber': union_id,
-                'info': user_uuid,
-                'DepartmentName': dept_path
-            })
+            if matched_sam:
+                # 用户已存在，更新用户（EmployeeID 使用工号，EmployeeNumber 使用 Union ID）
+                update_users.append(UpdateUser(
+                    SamAccountName=matched_sam,
+                    DisplayName=display_name,
+                    EmailAddress=email,
+                    EmployeeID=employee_no,
+                    EmployeeNumber=union_id,
+                    info=user_uuid,
+                    DepartmentName=dept_path
+                ))
+            else:
+                # 新建用户（EmployeeID 使用工号，EmployeeNumber 使用 Union ID）
+                new_users.append(NewUser(
+                    DisplayName=display_name,
+                    SamAccountName=sam_account,
+                    EmailAddress=email,
+                    EmployeeID=employee_no,
+                    EmployeeNumber=union_id,
+                    info=user_uuid,
+                    DepartmentName=dept_path
+                ))
     
     return new_users, update_users, matched_ad_users, matched_ad_users_no_uid
 
 def create_csv_files(new_users, update_users):
     """生成新建和更新的CSV文件"""
-    # 新建用户CSV
+    # 新建用户CSV（namedtuple行直接写出，无需DictWriter逐行按字段名取值）
     if new_users:
         with open(get_output_path('ad_new_accounts.csv'), 'w', newline='', encoding='utf-8-sig') as f:
-            writer = csv.DictWriter(f, fieldnames=['DisplayName', 'SamAccountName', 'EmailAddress', 'EmployeeID', 'EmployeeNumber', 'info', 'DepartmentName'])
-            writer.writeheader()
+            writer = csv.writer(f)
+            writer.writerow(NewUser._fields)
             writer.writerows(new_users)
         print(f"  - 待创建用户: {len(new_users)} 个")
-    
+
     # 更新用户CSV
     if update_users:
         with open(get_output_path('ad_check_accounts.csv'), 'w', newline='', encoding='utf-8-sig') as f:
-            writer = csv.DictWriter(f, fieldnames=['SamAccountName', 'DisplayName', 'EmailAddress', 'EmployeeID', 'EmployeeNumber', 'info', 'DepartmentName'])
-            writer.writeheader()
+            writer = csv.writer(f)
+            writer.writerow(UpdateUser._fields)
             writer.writerows(update_users)
         print(f"  - 待检查用户: {len(update_users)} 个（实际更新数量取决于字段差异）")
     
@@ -795,8 +918,7 @@ $DC_RESIGNED_OU = "{DC_RESIGNED_OU}"
         f.write(config_content)
     
     # 上传到域控制器（上传到远程用户主目录）
-    scp_cmd = f"sshpass -p '{DC_PASSWORD}' scp -o ControlPath={SSH_CONTROL_PATH} {config_file} {DC_USER}@{DC_HOST}:~/dc_config.ps1"
-    run_scp_with_retry(scp_cmd)
+    copy_to_dc(config_file, '~/dc_config.ps1')
     
     print("✓ 已上传配置到域控制器")
 
@@ -805,90 +927,70 @@ def execute_on_dc(operation, csv_file, ps_script, use_local=False):
     if not os.path.exists(csv_file):
         return 0
     
-    # 上传CSV到用户主目录
-    remote_csv = f"~/{os.path.basename(csv_file)}"
-    scp_cmd = f"sshpass -p '{DC_PASSWORD}' scp -o ControlPath={SSH_CONTROL_PATH} {csv_file} {DC_USER}@{DC_HOST}:{remote_csv}"
-    
-    # 重试上传
-    for attempt in range(3):
-        result = run_scp_with_retry(scp_cmd)
-        if result.returncode == 0:
-            break
-        if attempt < 2:
-            print(f"上传失败，{3-attempt} 秒后重试...")
-            import time
-            time.sleep(3)
-        else:
-            print(f"✗ 上传 CSV 失败: {result.stderr.decode('utf-8', errors='ignore')}")
-            return 0
-    
-    # 上传PowerShell脚本
+    # 定位PowerShell脚本
     if use_local:
         ps_local = ps_script
     else:
         ps_local = f"../domainusers/{ps_script}"
-    
+
     actual_count = 0
     if os.path.exists(ps_local):
-        remote_ps = f"~/{operation}.ps1"
-        scp_cmd = f"sshpass -p '{DC_PASSWORD}' scp -o ControlPath={SSH_CONTROL_PATH} {ps_local} {DC_USER}@{DC_HOST}:{remote_ps}"
-        
-        # 重试上传
+        # 脚本内容未变时只上传CSV；否则CSV和脚本合并为一次scp上传（保留原文件名）
+        skip_script = script_unchanged(ps_local)
+        upload_files = [csv_file] if skip_script else [csv_file, ps_local]
         for attempt in range(3):
-            result = run_scp_with_retry(scp_cmd)
+            result = copy_many_to_dc(upload_files)
             if result.returncode == 0:
+                if not skip_script:
+                    remember_script_hash(ps_local)
                 break
             if attempt < 2:
-                print(f"上传脚本失败，{3-attempt} 秒后重试...")
-                import time
+                print(f"上传失败，{3-attempt} 秒后重试...")
                 time.sleep(3)
             else:
-                print(f"✗ 上传脚本失败: {result.stderr.decode('utf-8', errors='ignore')}")
+                print(f"✗ 上传文件失败: {result.stderr.decode('utf-8', errors='ignore')}")
                 return 0
-        
+
         # 执行脚本，dry-run 模式传递 -DryRun 参数
         print(f"正在执行...")
         dry_run_flag = "-DryRun" if DRY_RUN else ""
-        # PowerShell 脚本路径
-        script_path = f"{DC_USER_HOME}/{operation}.ps1"
+        # PowerShell 脚本路径（上传保留原文件名）
+        script_path = f"{DC_USER_HOME}/{os.path.basename(ps_local)}"
         # 使用 PowerShell 命令包装，重定向信息流
         ps_command = f"& '{script_path}' {dry_run_flag} *>&1"
-        ssh_cmd = f"sshpass -p '{DC_PASSWORD}' ssh -o StrictHostKeyChecking=no -o ControlPath={SSH_CONTROL_PATH} {DC_USER}@{DC_HOST} 'powershell -ExecutionPolicy Bypass -Command \"{ps_command}\"'"
-        result = run_ssh_with_retry(ssh_cmd)
+        result = run_on_dc(f'powershell -ExecutionPolicy Bypass -Command "{ps_command}"')
         
-        # 尝试解码输出（PowerShell 已设置 UTF-8 输出）
-        try:
-            output = result.stdout.decode('utf-8', errors='replace')
-            if output.strip():
-                print(output)
-            else:
-                print("（脚本无输出）")
-            
-            # 提取实际处理的用户数
-            if DRY_RUN:
-                match = re.search(r'将(?:更新|创建): (\d+) 个用户', output)
-            else:
-                match = re.search(r'成功: (\d+) 个用户', output)
+        # SSH以文本模式运行，stdout已是str（非法字节被替换，不会抛异常）
+        output = result.stdout or ''
+        if output.strip():
+            print(output)
+        else:
+            print("（脚本无输出）")
+
+        # 优先解析脚本末尾的结构化结果行（##RESULT## + JSON），
+        # 不受输出措辞影响；没有结果行时退回正则提取
+        for line in reversed(output.splitlines()):
+            if line.startswith('##RESULT##'):
+                try:
+                    actual_count = int(json.loads(line[len('##RESULT##'):])['success'])
+                except (ValueError, KeyError):
+                    pass
+                break
+        else:
+            match = (_RE_COUNT_DRYRUN if DRY_RUN else _RE_COUNT_LIVE).search(output)
             if match:
                 actual_count = int(match.group(1))
-        except Exception as e:
-            print(f"脚本执行完成（输出解码失败: {e}）")
-        
+
         if result.stderr:
-            try:
-                error = result.stderr.decode(encoding)
-                print("错误:", error)
-            except:
-                pass
+            print("错误:", result.stderr)
     
     return actual_count
 
 def download_file_from_dc(remote_filename, local_path):
     """从域控制器下载文件"""
     try:
-        scp_cmd = f"sshpass -p '{DC_PASSWORD}' scp -o ControlPath={SSH_CONTROL_PATH} {DC_USER}@{DC_HOST}:~/{remote_filename} {local_path}"
-        result = run_scp_with_retry(scp_cmd)
-        
+        result = copy_from_dc(f'~/{remote_filename}', local_path)
+
         if result.returncode == 0:
             print(f"✓ 已下载: {remote_filename}")
             return True
@@ -905,8 +1007,7 @@ def download_passwords():
     
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     password_file = get_output_path(f"ad_passwords_{timestamp}.csv")
-    scp_cmd = f"sshpass -p '{DC_PASSWORD}' scp -o ControlPath={SSH_CONTROL_PATH} {DC_USER}@{DC_HOST}:~/GeneratedPasswords.csv {password_file}"
-    result = run_scp_with_retry(scp_cmd)
+    result = copy_from_dc('~/GeneratedPasswords.csv', password_file)
     
     if result.returncode == 0:
         print(f"✓ 密码文件已保存到: {password_file}")
@@ -918,66 +1019,88 @@ def download_passwords():
 
 def send_password_emails(password_file):
     """读取密码文件并发送邮件"""
-    from send_password_email import send_password_email
+    from send_password_email import send_password_emails_bulk
     
     # 从环境变量获取公司名称
     company_name = os.getenv("FEISHU_COMPANY_NAME", "公司")
     
     print("\n正在发送密码邮件...")
     
-    # 读取密码文件
-    try:
-        encoding = get_windows_encoding()
-        with open(password_file, 'r', encoding=encoding) as f:
-            reader = csv.DictReader(f)
-            passwords = list(reader)
-    except:
-        # 尝试其他编码
-        with open(password_file, 'r', encoding='utf-8-sig') as f:
-            reader = csv.DictReader(f)
-            passwords = list(reader)
-    
     success_count = 0
     fail_count = 0
-    
-    for row in passwords:
-        sam_account = row['SamAccountName']
-        display_name = row['DisplayName']
-        email = row['EmailAddress']
-        password = row['Password']
-        department = row.get('Department', '')
-        
-        # 如果部门为空，使用公司名称
-        if not department or department.strip() == '':
-            department = company_name
-        
-        if email and password != '[DRY-RUN]':
-            try:
-                success, message = send_password_email(
-                    receiver_email=email,
-                    new_password=password,
-                    sam_account=sam_account,
-                    display_name=display_name,
-                    department=department
-                )
-                
-                if success:
-                    success_count += 1
-                else:
-                    print(f"✗ 发送失败: {sam_account} - {message}")
-                    fail_count += 1
-            except Exception as e:
-                print(f"✗ 发送异常: {sam_account} - {e}")
-                fail_count += 1
-        else:
+    skipped_no_email = []
+    skipped_dry_run = 0
+
+    # 流式读取密码文件（编码按文件前缀探测一次），一遍分拣出
+    # 待发送、无邮箱、DRY-RUN三类行，跳过的行不算失败
+    rows_to_send = []
+    with open(password_file, 'r', newline='', encoding=detect_csv_encoding(password_file)) as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        sam_i = header.index('SamAccountName')
+        name_i = header.index('DisplayName')
+        email_i = header.index('EmailAddress')
+        pwd_i = header.index('Password')
+        dept_i = header.index('Department') if 'Department' in header else None
+
+        for row in reader:
+            sam_account = row[sam_i]
+            email = row[email_i]
+            password = row[pwd_i]
+            # 部门读取时直接归一化：空白部门落到公司名称
+            department = (row[dept_i].strip() if dept_i is not None else '') or company_name
+
             if not email:
-                print(f"⚠ 跳过: {sam_account} (无邮箱)")
+                skipped_no_email.append(sam_account)
+            elif password == '[DRY-RUN]':
+                skipped_dry_run += 1
+            else:
+                rows_to_send.append({
+                    'receiver_email': email,
+                    'new_password': password,
+                    'sam_account': sam_account,
+                    'display_name': row[name_i],
+                    'department': department
+                })
+
+    if skipped_no_email:
+        print(f"⚠ 跳过 {len(skipped_no_email)} 个无邮箱用户: {', '.join(skipped_no_email)}")
+    if skipped_dry_run:
+        print(f"⚠ 跳过 {skipped_dry_run} 个 DRY-RUN 行")
+
+    # 并发批量发送（线程池内复用SMTP连接）
+    for row, success, message in send_password_emails_bulk(rows_to_send):
+        if success:
+            success_count += 1
+        else:
+            print(f"✗ 发送失败: {row['sam_account']} - {message}")
             fail_count += 1
     
-    print(f"\n邮件发送完成: 成功 {success_count} 个, 失败 {fail_count} 个")
+    skipped_count = len(skipped_no_email) + skipped_dry_run
+    if skipped_count:
+        print(f"\n邮件发送完成: 成功 {success_count} 个, 失败 {fail_count} 个, 跳过 {skipped_count} 个")
+    else:
+        print(f"\n邮件发送完成: 成功 {success_count} 个, 失败 {fail_count} 个")
+
+def _iter_unmatched(source, matched_keys):
+    """按键集合差集生成未匹配的AD用户记录（差集在C层一次算完）"""
+    for key in source.keys() - matched_keys:
+        info = source[key]
+        yield {
+            'SamAccountName': info['SamAccountName'],
+            'DisplayName': info['DisplayName'],
+            'EmailAddress': info['EmailAddress'],
+            'EmployeeID': info.get('EmployeeID', ''),
+            'Enabled': info.get('Enabled', True),
+            'DistinguishedName': info.get('DistinguishedName', '')
+        }
 
 def process_unmatched_users(unmatched_users):
     """处理未匹配的用户：禁用并移动到离职员工 OU"""
+    # 没有未匹配用户时直接返回，不写CSV也不连域控
+    if not unmatched_users:
+        return 0
+
     # 过滤出需要处理的用户（未禁用或不在离职 OU 中）
     users_to_process = [
         u for u in unmatched_users
@@ -990,33 +1113,36 @@ def process_unmatched_users(unmatched_users):
     
     print(f"\n正在处理 {len(users_to_process)} 个未匹配用户...")
     
-    # 生成用户列表 CSV
-    with open(get_output_path('ad_resign_users.csv'), 'w', newline='', encoding='utf-8-sig') as f:
-        writer = csv.DictWriter(f, fieldnames=['SamAccountName', 'DisplayName', 'EmployeeID'])
-        writer.writeheader()
-        for user in users_to_process:
-            writer.writerow({
-                'SamAccountName': user['SamAccountName'],
-                'DisplayName': user['DisplayName'],
-                'EmployeeID': user.get('EmployeeID', '')
-            })
+    # 生成用户列表 CSV（writerows一次批量写入）
+    resign_csv = get_output_path('ad_resign_users.csv')
+    with open(resign_csv, 'w', newline='', encoding='utf-8-sig') as f:
+        writer = csv.writer(f)
+        writer.writerow(['SamAccountName', 'DisplayName', 'EmployeeID'])
+        writer.writerows(
+            (u['SamAccountName'], u['DisplayName'], u.get('EmployeeID', ''))
+            for u in users_to_process
+        )
     
     # 调用 PowerShell 脚本处理
-    return execute_on_dc('ResignUsers', get_output_path('ad_resign_users.csv'), get_ps_path('resign_users.ps1'), use_local=True)
+    return execute_on_dc('ResignUsers', resign_csv, get_ps_path('resign_users.ps1'), use_local=True)
 
 def delete_extra_ous(extra_ous):
     """删除多余的 OU"""
+    # 没有多余OU时直接返回，不写CSV也不连域控
+    if not extra_ous:
+        return
+
     print(f"\n正在删除 {len(extra_ous)} 个多余的 OU...")
     
-    # 生成 OU 列表 CSV
-    with open(get_output_path('ad_delete_ous.csv'), 'w', newline='', encoding='utf-8-sig') as f:
+    # 生成 OU 列表 CSV（writerows一次批量写入）
+    delete_csv = get_output_path('ad_delete_ous.csv')
+    with open(delete_csv, 'w', newline='', encoding='utf-8-sig') as f:
         writer = csv.writer(f)
         writer.writerow(['OU名称'])
-        for ou in extra_ous:
-            writer.writerow([ou])
-    
+        writer.writerows([ou] for ou in extra_ous)
+
     # 调用 PowerShell 脚本删除
-    execute_on_dc('DeleteOUs', get_output_path('ad_delete_ous.csv'), get_ps_path('delete_ou.ps1'), use_local=True)
+    execute_on_dc('DeleteOUs', delete_csv, get_ps_path('delete_ou.ps1'), use_local=True)
 
 def sync_departments():
     """同步部门OU结构到AD域"""
@@ -1027,55 +1153,41 @@ def sync_departments():
     
     print("正在同步部门结构...")
     
-    # 读取飞书部门列表
-    feishu_depts = set()
+    # 读取飞书部门列表（集合推导一次建集）
     with open(dept_csv, 'r', encoding='utf-8-sig') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            feishu_depts.add(row['dept_name'])
-    
+        feishu_depts = {row['dept_name'] for row in csv.DictReader(f)}
+
     # 获取 AD 现有部门（返回 {DN: 名称}）
     ad_depts_dict = get_existing_ad_departments()
     ad_dept_names = set(ad_depts_dict.values())  # 提取所有 OU 名称
+
+    # 找出 AD 中多余的 OU（AD 有但飞书没有），集合差集一次算完
+    extra_ous = list(ad_dept_names - feishu_depts)
     
-    # 找出 AD 中多余的 OU（AD 有但飞书没有）
-    extra_ous = []
-    for ou_name in ad_dept_names:
-        if ou_name not in feishu_depts:
-            extra_ous.append(ou_name)
-    
-    # 上传部门CSV
-    scp_cmd = f"sshpass -p '{DC_PASSWORD}' scp -o ControlPath={SSH_CONTROL_PATH} {dept_csv} {DC_USER}@{DC_HOST}:~/feishu_departments.csv"
-    run_scp_with_retry(scp_cmd)
-    
-    # 上传PowerShell脚本
+    # 检查PowerShell脚本
     ps_script = get_ps_path('create_ou.ps1')
     if not os.path.exists(ps_script):
         print(f"❌ 错误: 找不到 {ps_script}")
         print("无法同步部门结构，同步失败！")
         sys.exit(1)
-    
-    scp_cmd = f"sshpass -p '{DC_PASSWORD}' scp -o ControlPath={SSH_CONTROL_PATH} {ps_script} {DC_USER}@{DC_HOST}:~/CreateOU.ps1"
-    run_scp_with_retry(scp_cmd)
-    
+
+    # 部门CSV与脚本合并为一次scp上传（保留原文件名，脚本未变时跳过）
+    if script_unchanged(ps_script):
+        copy_to_dc(dept_csv, '~/feishu_departments.csv')
+    else:
+        result = copy_many_to_dc([dept_csv, ps_script])
+        if result.returncode == 0:
+            remember_script_hash(ps_script)
+
     # 执行脚本，dry-run 模式传递 -DryRun 参数
     dry_run_flag = "-DryRun" if DRY_RUN else ""
-    ssh_cmd = f"sshpass -p '{DC_PASSWORD}' ssh -o StrictHostKeyChecking=no -o ControlPath={SSH_CONTROL_PATH} {DC_USER}@{DC_HOST} 'powershell -ExecutionPolicy Bypass -File {DC_USER_HOME}/CreateOU.ps1 {dry_run_flag}'"
-    result = run_ssh_with_retry(ssh_cmd)
-    
-    # 尝试解码输出（PowerShell 已设置 UTF-8 输出）
-    try:
-        output = result.stdout.decode('utf-8', errors='replace')
-        print(output)
-    except:
-        print(f"（部分输出无法显示）")
+    result = run_on_dc(f'powershell -ExecutionPolicy Bypass -File {DC_USER_HOME}/create_ou.ps1 {dry_run_flag}')
     
+    # SSH以文本模式运行，stdout/stderr已是str（非法字节被替换）
+    print(result.stdout or '')
+
     if result.stderr:
-        try:
-            error = result.stderr.decode('utf-8', errors='replace')
-            print("错误:", error)
-        except:
-            print("有错误输出（解码失败）")
+        print("错误:", result.stderr)
     
     print("✓ 部门CSV已上传到域控制器，可供后续脚本使用")
     
@@ -1085,14 +1197,15 @@ def sync_departments():
 def cleanup_remote_files():
     """清理远程服务器上的临时文件"""
     remote_files = [
-        'GetOUs.ps1',
-        'ExportUsers.ps1',
-        'CreateOU.ps1',
-        'CreateAccounts.ps1',
-        'UpdateAccounts.ps1',
+        'export_all.ps1',
+        'create_ou.ps1',
+        'create_users.ps1',
+        'update_users.ps1',
+        'resign_users.ps1',
         'dc_config.ps1',
         'ExistingOUs.csv',
         'ExportedUsers.csv',
+        'ad_dump.zip',
         'feishu_departments.csv',
         'feishu_users_new.csv',
         'feishu_users_update.csv',
@@ -1103,22 +1216,32 @@ def cleanup_remote_files():
     ]
     
     try:
-        # 批量删除所有文件（单次SSH调用）
-        files_str = ','.join([f"~/{f}" for f in remote_files])
-        ssh_cmd = f"sshpass -p '{DC_PASSWORD}' ssh -o StrictHostKeyChecking=no -o ControlPath={SSH_CONTROL_PATH} {DC_USER}@{DC_HOST} 'powershell -Command \"Remove-Item -Path {files_str} -ErrorAction SilentlyContinue\"'"
-        run_ssh_with_retry(ssh_cmd, timeout=10)
+        # 批量删除所有文件（单次SSH调用）：显式PowerShell数组 + LiteralPath，
+        # 路径基于 $env:USERPROFILE 拼接，不依赖 ~ 展开
+        files_array = '@(' + ','.join(f"'{f}'" for f in remote_files) + ')'
+        ps_cleanup = (f"{files_array} | ForEach-Object {{ "
+                      "Remove-Item -LiteralPath (Join-Path $env:USERPROFILE $_) "
+                      "-ErrorAction SilentlyContinue }")
+        # 先失效哈希缓存再发删除命令：删除已执行但本地超时的情况下，
+        # 陈旧缓存只会多付一次上传，不会跳过对已删脚本的上传
+        invalidate_script_hashes()
+        run_on_dc(f'powershell -Command "{ps_cleanup}"', timeout=10)
         print("✓ 远程临时文件已清理")
     except:
         print("⚠ 清理远程文件时出现问题（可忽略）")
 
 if __name__ == "__main__":
-    # 清理旧的 SSH 控制套接字
-    import glob
-    for socket_file in glob.glob("/tmp/ssh-feishu-ad-sync-*"):
-        try:
-            os.remove(socket_file)
-        except:
-            pass
+    # 清理旧的 SSH 控制套接字（scandir+前缀匹配，不在大/tmp上跑fnmatch）
+    try:
+        with os.scandir('/tmp') as entries:
+            for entry in entries:
+                if entry.name.startswith('ssh-feishu-ad-sync-'):
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+    except OSError:
+        pass
     
     # 检查命令行参数
     for arg in sys.argv[1:]:
@@ -1165,8 +1288,8 @@ if __name__ == "__main__":
             sys.exit(1)
         print("✓ 飞书数据获取完成")
     
-    # 检查域控制器权限
-    if not check_dc_permissions():
+    # 检查域控制器权限（与远程用户主目录探测并行执行）
+    if not run_startup_probes():
         print("\n错误: 域控制器权限检查失败")
         print("请确保:")
         print("  1. 域控制器地址、用户名、密码配置正确")
@@ -1205,31 +1328,10 @@ if __name__ == "__main__":
         print(f"  ⚠ {unmatched_ad_count} 个 AD 用户在飞书中未找到匹配")
         
         # 导出未匹配的 AD 用户（包括有 Union ID 和没有 Union ID 的）
-        unmatched_users = []
-        
-        # 未匹配的有 Union ID 的用户
-        for union_id, info in existing_users.items():
-            if union_id not in matched_ad_users:
-                unmatched_users.append({
-                    'SamAccountName': info['SamAccountName'],
-                    'DisplayName': info['DisplayName'],
-                    'EmailAddress': info['EmailAddress'],
-                    'EmployeeID': info.get('EmployeeID', ''),
-                    'Enabled': info.get('Enabled', True),
-                    'DistinguishedName': info.get('DistinguishedName', '')
-                })
-        
-        # 未匹配的没有 Union ID 的用户
-        for sam, info in users_without_union_id.items():
-            if sam not in matched_ad_users_no_uid:
-                unmatched_users.append({
-                    'SamAccountName': info['SamAccountName'],
-                    'DisplayName': info['DisplayName'],
-                    'EmailAddress': info['EmailAddress'],
-                    'EmployeeID': info.get('EmployeeID', ''),
-                    'Enabled': info.get('Enabled', True),
-                    'DistinguishedName': info.get('DistinguishedName', '')
-                })
+        # 列表后续要被多处使用（统计、写CSV、离职处理），物化一次
+        unmatched_users = list(chain(
+            _iter_unmatched(existing_users, matched_ad_users),
+            _iter_unmatched(users_without_union_id, matched_ad_users_no_uid)))
         
         # 统计禁用用户数量
         disabled_unmatched = sum(1 for u in unmatched_users if not u.get('Enabled', True))
@@ -1243,17 +1345,13 @@ if __name__ == "__main__":
         # 只有当有需要处理的用户时，才保存 CSV
         if users_need_process > 0:
             with open(get_output_path('ad_unmatched_users.csv'), 'w', newline='', encoding='utf-8-sig') as f:
-                writer = csv.DictWriter(f, fieldnames=['SamAccountName', 'DisplayName', 'EmailAddress', 'EmployeeID', 'Enabled'])
-                writer.writeheader()
-                # 不导出 DistinguishedName 到 CSV（太长）
-                for u in unmatched_users:
-                    writer.writerow({
-                        'SamAccountName': u['SamAccountName'],
-                        'DisplayName': u['DisplayName'],
-                        'EmailAddress': u['EmailAddress'],
-                        'EmployeeID': u['EmployeeID'],
-                        'Enabled': u['Enabled']
-                    })
+                writer = csv.writer(f)
+                writer.writerow(['SamAccountName', 'DisplayName', 'EmailAddress', 'EmployeeID', 'Enabled'])
+                # 不导出 DistinguishedName 到 CSV（太长）；writerows一次批量写入
+                writer.writerows(
+                    (u['SamAccountName'], u['DisplayName'], u['EmailAddress'], u['EmployeeID'], u['Enabled'])
+                    for u in unmatched_users
+                )
             
             if disabled_unmatched > 0:
                 print(f"  - {unmatched_ad_count} 个未匹配用户列表已保存到: output/ad_unmatched_users.csv（其中 {disabled_unmatched} 个已经是禁用状态）")
@@ -1281,24 +1379,37 @@ if __name__ == "__main__":
         print("\n没有需要同步的用户")
         sys.exit(0)
     
-    # 4. 执行新建
+    # 4. 执行新建；5. 执行更新
+    # 更新步骤与密码下载/邮件发送没有数据依赖：两者都要做时，把更新
+    # 放进后台线程，DC端的PowerShell执行与SCP下载、SMTP发信重叠
+    # （SSH多路复用允许同一主连接上并发开通道）
     actual_new_count = 0
+    actual_update_count = 0
+
+    def run_update_step():
+        return execute_on_dc('UpdateAccounts', get_output_path('ad_check_accounts.csv'), get_ps_path('update_users.ps1'), use_local=True)
+
     if new_count > 0:
         print(f"\n【步骤 4/6】创建新用户、下载密码并发送邮件 ({new_count} 个)")
         actual_new_count = execute_on_dc('CreateAccounts', get_output_path('ad_new_accounts.csv'), get_ps_path('create_users.ps1'), use_local=True)
-        # 创建成功后立即下载密码
-        if actual_new_count > 0 and not DRY_RUN:
+        if update_count > 0:
+            print(f"\n【步骤 5/6】检查并更新 AD 域现有用户 ({update_count} 个，与密码处理并行)")
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                update_future = pool.submit(run_update_step)
+                # 创建成功后立即下载密码并发送邮件
+                if actual_new_count > 0 and not DRY_RUN:
+                    download_passwords()
+                actual_update_count = update_future.result()
+        elif actual_new_count > 0 and not DRY_RUN:
+            # 创建成功后立即下载密码
             download_passwords()
-    
-    # 5. 执行更新
-    actual_update_count = 0
-    if update_count > 0:
+    elif update_count > 0:
         print(f"\n【步骤 5/6】检查并更新 AD 域现有用户 ({update_count} 个)")
-        actual_update_count = execute_on_dc('UpdateAccounts', get_output_path('ad_check_accounts.csv'), get_ps_path('update_users.ps1'), use_local=True)
-        
-        # 下载实际更新成功的用户文件（非DRY_RUN模式且有更新时）
-        if actual_update_count > 0 and not DRY_RUN:
-            download_file_from_dc('ad_updated_accounts.csv', get_output_path('ad_updated_accounts.csv'))
+        actual_update_count = run_update_step()
+
+    # 下载实际更新成功的用户文件（非DRY_RUN模式且有更新时）
+    if actual_update_count > 0 and not DRY_RUN:
+        download_file_from_dc('ad_updated_accounts.csv', get_output_path('ad_updated_accounts.csv'))
     
     # 处理多余的OU（在用户移动完成后）
     if extra_ous and not DRY_RUN:
@@ -1361,7 +1472,7 @@ if __name__ == "__main__":
                     success_file = get_output_path('ad_updated_accounts.csv')
                     if os.path.exists(success_file):
                         try:
-                            with open(success_file, 'r', encoding='utf-8-sig') as f:
+                            with open(success_file, 'r', encoding=detect_csv_encoding(success_file)) as f:
                                 reader = csv.DictReader(f)
                                 update_details = []
                                 for i, row in enumerate(reader):